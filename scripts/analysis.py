@@ -0,0 +1,203 @@
+# This file analyzes a whole recording in memory: it detects the QRS
+# complexes, cuts out every beat, classifies the beats in large batches and
+# summarizes the heart rate. It can be run on a WFDB record from the
+# command line or called by the inference service on a raw signal.
+
+import argparse
+import json
+import numpy as np
+from wfdb import processing
+import beat_window
+import beat_renderer
+
+CLASSES_TO_CHECK = ['L', 'N', 'V', 'A', 'R']
+
+# number of beats rendered and classified at once
+BATCH_SIZE = 256
+
+# XQRS filters the signal with a wavelet as wide as a qrs complex (0.1 s)
+# and needs more than 3 times that to pad it; shorter signals can not
+# hold a beat, no detection is run on them
+MIN_SIGNAL_SECONDS = 0.3
+
+
+def detectQRS(signal, fs):
+    '''
+    run XQRS detection over a whole signal
+
+    Args:
+            signal (numpy array): samples of signal
+
+            fs (int): frequency of signal
+
+    Returns:
+            xqrs (XQRS object): detector holding the qrs locations
+    '''
+    xqrs = processing.XQRS(sig=signal, fs=fs)
+    xqrs.detect(verbose=False)
+    return xqrs
+
+
+def getBeatsFromPeaks(signal, qrs_locs):
+    '''
+    cut beats out of a signal, using the same window as extraction
+    (BEAT_START_OFFSET before a peak up to BEAT_END_OFFSET before next peak)
+
+    Args:
+            signal (numpy array): samples of signal
+
+            qrs_locs (list): qrs locations in the signal
+
+    Returns:
+            (list): list of beats (views of signal)
+    '''
+    beats = []
+    for beat_number in range(len(qrs_locs) - 1):
+        beat_start = qrs_locs[beat_number] - beat_window.BEAT_START_OFFSET
+        beat_end = qrs_locs[beat_number + 1] - beat_window.BEAT_END_OFFSET
+        beats.append(beat_window.sliceSignal(signal, beat_start, beat_end))
+    return beats
+
+
+def toModelInput(images, channels):
+    '''
+    shape gray beat images the way the model expects them
+
+    Args:
+            images (numpy array): uint8 images of shape (beats, height, width)
+
+            channels (int): number of channels of model input
+
+    Returns:
+            (numpy array): images of shape (beats, height, width, channels)
+    '''
+    images = images[..., np.newaxis]
+    if channels > 1:
+        images = np.repeat(images, channels, axis=-1)
+    return images
+
+
+def classifyBeats(beats, predict_fn, channels=3, batch_size=BATCH_SIZE):
+    '''
+    render and classify beats in batches
+
+    Args:
+            beats (list): list of beats to classify
+
+            predict_fn (function): takes a batch of images, returns probabilities
+
+            channels (int): number of channels of model input
+
+            batch_size (int): number of beats classified at once
+
+    Returns:
+            probs (numpy array): probabilities of shape (beats, classes)
+    '''
+    probs = np.zeros((len(beats), len(CLASSES_TO_CHECK)), dtype=np.float32)
+    for start in range(0, len(beats), batch_size):
+        images = beat_renderer.renderBeats(beats[start:start + batch_size])
+        probs[start:start + len(images)] = predict_fn(
+            toModelInput(images, channels))
+    return probs
+
+
+def analyzeSignal(signal, fs, predict_fn, channels=3, batch_size=BATCH_SIZE):
+    '''
+    detect, segment and classify all beats of a signal
+
+    Args:
+            signal (numpy array): samples of signal (single channel)
+
+            fs (int): frequency of signal
+
+            predict_fn (function): takes a batch of images, returns probabilities
+
+            channels (int): number of channels of model input
+
+            batch_size (int): number of beats classified at once
+
+    Returns:
+            (dict): per-beat labels, probabilities and sample positions, and
+            heart rate summary (no beats for signals of MIN_SIGNAL_SECONDS
+            or less)
+    '''
+    if fs <= 0:
+        raise ValueError("Frequency of signal must be positive")
+    signal = np.asarray(signal, dtype=np.float64).reshape(-1)
+
+    if len(signal) > MIN_SIGNAL_SECONDS * fs:
+        xqrs = detectQRS(signal, fs)
+        qrs_locs = np.asarray(xqrs.qrs_inds, dtype=np.int64)
+    else:
+        qrs_locs = np.zeros(0, dtype=np.int64)
+
+    beats = getBeatsFromPeaks(signal, qrs_locs)
+    probs = classifyBeats(beats, predict_fn, channels, batch_size)
+    labels = [CLASSES_TO_CHECK[i] for i in probs.argmax(axis=-1)]
+
+    # heart rate
+    if len(qrs_locs) > 1:
+        heart_rates = processing.compute_hr(len(signal), qrs_locs, fs)
+        # heart rate at the end of the signal, as signal_api.calculateHeartRate
+        heart_rate = float(heart_rates[-1])
+        mean_heart_rate = float(np.nanmean(heart_rates))
+    else:
+        heart_rate = None
+        mean_heart_rate = None
+
+    return {
+        'fs': fs,
+        'num_samples': len(signal),
+        'num_beats': len(beats),
+        'heart_rate': heart_rate,
+        'mean_heart_rate': mean_heart_rate,
+        'label_counts': {c: labels.count(c) for c in CLASSES_TO_CHECK},
+        'beats': [{'sample': int(qrs_locs[i]),
+                   'label': labels[i],
+                   'probabilities': probs[i].tolist()}
+                  for i in range(len(beats))],
+    }
+
+
+def analyzeRecord(file_path, predict_fn, channels=3, batch_size=BATCH_SIZE):
+    '''
+    detect, segment and classify all beats of a WFDB record
+
+    Args:
+            file_path (str): path of record (without extension)
+
+    Returns:
+            (dict): see analyzeSignal
+    '''
+    # reading records needs signal_api, which the service does not load
+    import signal_api
+
+    signal, fields = signal_api.getRecordSignal(file_path)
+    return analyzeSignal(signal[:, 0], fields['fs'], predict_fn, channels,
+                         batch_size)
+
+
+if __name__ == '__main__':
+    from tensorflow import keras
+
+    args = argparse.ArgumentParser()
+    args.add_argument('--record', type=str, required=True,
+                      help='path of WFDB record (without extension)')
+    args.add_argument('--model', type=str, default='model/vgg16.h5',
+                      help='path of trained model')
+    args.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                      help='number of beats classified at once')
+    args.add_argument('--output', type=str, default=None,
+                      help='write json result to this file instead of stdout')
+    args = args.parse_args()
+
+    model = keras.models.load_model(args.model)
+    result = analyzeRecord(args.record, model.predict,
+                           channels=model.input_shape[-1],
+                           batch_size=args.batch_size)
+
+    if args.output is None:
+        print(json.dumps(result))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(result, f)
@@ -1,12 +1,122 @@
-from tensorflow import keras
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response
 import uvicorn
 import cv2
+import io
+import os
+import json
+import time
+import queue
+import random
+import asyncio
+import logging
+import logging.handlers
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from batching import MicroBatcher
+from prediction_cache import PredictionCache, file_version
+from streaming import BeatStream
+import beat_renderer
+import analysis
+import metrics
 
-MODEL_PATH = "model/vgg16.h5"
+# keras (.h5, full tensorflow) or tflite (quantized model written by
+# export_model.py, run with tflite_runtime when it is installed)
+MODEL_BACKEND = os.environ.get("MODEL_BACKEND", "keras")
+DEFAULT_MODEL_PATHS = {"keras": "model/vgg16.h5",
+                       "tflite": "model/vgg16.int8.tflite"}
+MODEL_PATH = os.environ.get("MODEL_PATH", DEFAULT_MODEL_PATHS.get(MODEL_BACKEND))
+# threads of tflite interpreter (default: runtime decides)
+TFLITE_THREADS = int(os.environ["TFLITE_THREADS"]) if "TFLITE_THREADS" in os.environ else None
 app = FastAPI()
+
+# requests are batched until this many are waiting or the delay has passed
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 32))
+BATCH_MAX_DELAY_MS = float(os.environ.get("BATCH_MAX_DELAY_MS", 5))
+# fraction of requests and predictions that are logged
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 0.01))
+# open streaming sessions allowed at once
+MAX_STREAM_SESSIONS = int(os.environ.get("MAX_STREAM_SESSIONS", 100))
+# predictions of this many inputs are kept in memory (0: no cache), and
+# also on disk in PREDICTION_CACHE_DIR if it is set
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", 10000))
+PREDICTION_CACHE_DIR = os.environ.get("PREDICTION_CACHE_DIR")
+
+# model loaded once at startup and kept for the life of the process
+served_model = None
+model_load_seconds = None
+# channels of served model input (1: gray, 3: BGR)
+image_channels = 3
+batcher = None
+prediction_cache = None
+# writes of the disk tier of the cache, and the ones not done yet
+cache_writer = None
+pending_saves = set()
+
+# live streams by session id
+streams = {}
 image_folder = "/home/hieppm/hieppm/beat_write_dir"
 
+logger = logging.getLogger("heartbeat_service")
+log_listener = None
+
+# metrics served on /metrics
+registry = metrics.Registry()
+REQUESTS = metrics.Counter(
+    "heartbeat_requests", "HTTP requests handled",
+    ["endpoint", "status"], registry)
+REQUEST_SECONDS = metrics.Histogram(
+    "heartbeat_request_seconds", "Latency of HTTP requests",
+    ["endpoint"], registry)
+DECODE_SECONDS = metrics.Histogram(
+    "heartbeat_decode_seconds", "Time decoding images and signals",
+    ["input"], registry)
+PREPROCESS_SECONDS = metrics.Histogram(
+    "heartbeat_preprocess_seconds", "Time resizing images and rendering beats",
+    ["input"], registry)
+FORWARD_SECONDS = metrics.Histogram(
+    "heartbeat_forward_seconds", "Time of forward passes of the model",
+    ["source"], registry)
+BATCH_SIZE = metrics.Histogram(
+    "heartbeat_batch_size", "Inputs in each forward pass", ["source"], registry,
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+QUEUE_DEPTH = metrics.Gauge(
+    "heartbeat_queue_depth", "Inputs waiting for a batch", registry=registry)
+MODEL_LOAD_SECONDS = metrics.Gauge(
+    "heartbeat_model_load_seconds", "Time loading and warming up the model",
+    registry=registry)
+STREAM_SESSIONS = metrics.Gauge(
+    "heartbeat_stream_sessions", "Open streaming sessions", registry=registry)
+PREDICTIONS = metrics.Counter(
+    "heartbeat_predictions", "Classified beats", ["label"], registry)
+
+CACHE_LOOKUPS = metrics.Counter(
+    "heartbeat_prediction_cache_lookups", "Lookups of the prediction cache",
+    ["result"], registry)
+CACHE_ENTRIES = metrics.Gauge(
+    "heartbeat_prediction_cache_entries", "Predictions held in memory",
+    registry=registry)
+
+QUEUE_DEPTH.set_function(lambda: batcher.depth() if batcher is not None else 0)
+STREAM_SESSIONS.set_function(lambda: len(streams))
+CACHE_ENTRIES.set_function(
+    lambda: len(prediction_cache) if prediction_cache is not None else 0)
+
+# children used on every request
+DECODE_PATH = DECODE_SECONDS.labels("path")
+DECODE_IMAGE = DECODE_SECONDS.labels("image")
+DECODE_SIGNAL = DECODE_SECONDS.labels("signal")
+PREPROCESS_IMAGE = PREPROCESS_SECONDS.labels("image")
+PREPROCESS_SIGNAL = PREPROCESS_SECONDS.labels("signal")
+FORWARD_BATCHER = FORWARD_SECONDS.labels("batcher")
+FORWARD_ANALYZE = FORWARD_SECONDS.labels("analyze")
+BATCH_SIZE_BATCHER = BATCH_SIZE.labels("batcher")
+BATCH_SIZE_ANALYZE = BATCH_SIZE.labels("analyze")
+CACHE_RESULTS = {"memory": CACHE_LOOKUPS.labels("hit"),
+                 "disk": CACHE_LOOKUPS.labels("disk_hit"),
+                 None: CACHE_LOOKUPS.labels("miss")}
+
 
 CLASSES_TO_CHECK = ['L', 'N', 'V', 'A', 'R']
 description = {
@@ -18,22 +128,180 @@ description = {
 }
 
 
-def load_model(model_path: str):
+def setup_logging():
+    # records are written by a listener thread, logging never waits on
+    # stdout in the event loop
+    global log_listener
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    log_listener = logging.handlers.QueueListener(log_queue, handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    log_listener.start()
+
+
+def log_event(event, sample_rate=1.0, **fields):
+    # one json line per event, only a sample_rate fraction of events is kept
+    if sample_rate < 1.0 and random.random() >= sample_rate:
+        return
+    fields["event"] = event
+    fields["time"] = time.time()
+    if sample_rate < 1.0:
+        fields["sample_rate"] = sample_rate
+    logger.info(json.dumps(fields))
+
+
+def load_model(model_path: str, backend: str = "keras"):
+    if backend == "tflite":
+        from tflite_backend import TFLiteModel
+        return TFLiteModel(model_path, num_threads=TFLITE_THREADS,
+                           max_batch_size=BATCH_MAX_SIZE)
+    if backend != "keras":
+        raise ValueError("MODEL_BACKEND must be in list {keras, tflite}")
+    from tensorflow import keras
     model = keras.models.load_model(model_path)
     model.compile(loss="categorical_crossentropy",
                   optimizer="adam", metrics=["accuracy"])
     return model
 
 
-def predict(model, image):
-    img = cv2.imread(image)
-    img = cv2.resize(img, (224, 224))
-    img = img.reshape(1, 224, 224, 3)
-    prob = model.predict(img)
+def warm_up(model):
+    # first forward pass builds the graph, do it before serving requests;
+    # tflite models run every batch size they hold an interpreter for
+    input_shape = model.input_shape[1:]
+    for batch_size in getattr(model, "batch_sizes", [1]):
+        model.predict(np.zeros((batch_size,) + tuple(input_shape), dtype=np.float32))
+
+
+def read_flag(channels):
+    return cv2.IMREAD_GRAYSCALE if channels == 1 else cv2.IMREAD_COLOR
+
+
+def read_image(image, channels=3):
+    with DECODE_PATH.time():
+        img = cv2.imread(image, read_flag(channels))
+    with PREPROCESS_IMAGE.time():
+        img = cv2.resize(img, (224, 224))
+        return img.reshape(224, 224, channels)
+
+
+def decode_image(data: bytes, channels=3):
+    # png/jpeg bytes decoded in memory, same layout as read_image
+    if not data:
+        raise ValueError("Body is empty")
+    with DECODE_IMAGE.time():
+        try:
+            img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), read_flag(channels))
+        except cv2.error:
+            img = None
+    if img is None:
+        raise ValueError("Body is not a png or jpeg image")
+    with PREPROCESS_IMAGE.time():
+        img = cv2.resize(img, (224, 224))
+        return img.reshape(224, 224, channels)
+
+
+def decode_signal(data: bytes, dtype: str = "float32"):
+    with DECODE_SIGNAL.time():
+        return decode_signal_bytes(data, dtype)
+
+
+def decode_signal_bytes(data: bytes, dtype: str = "float32"):
+    # .npy bytes, or raw little-endian float samples of a single beat
+    if data[:6] == b"\x93NUMPY":
+        signal = np.load(io.BytesIO(data), allow_pickle=False)
+        if signal.dtype.kind not in "iuf":
+            raise ValueError("Samples must be integer or float, not {}".format(signal.dtype))
+    else:
+        if dtype not in ("float32", "float64"):
+            raise ValueError("dtype must be in list {float32, float64}")
+        signal = np.frombuffer(data, dtype=np.dtype(dtype).newbyteorder("<"))
+    signal = np.asarray(signal, dtype=np.float64).reshape(-1)
+    if signal.size == 0:
+        raise ValueError("Body holds no samples")
+    if not np.isfinite(signal).all():
+        raise ValueError("Samples must be finite (no NaN or inf)")
+    return signal
+
+
+def signal_to_image(signal, channels=3):
+    # render beat the same way extraction does, laid out like read_image
+    with PREPROCESS_SIGNAL.time():
+        img = beat_renderer.renderBeat(signal)
+        if channels == 3:
+            return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        return img[:, :, np.newaxis]
+
+
+def observe_batch(batch_size, seconds):
+    BATCH_SIZE_BATCHER.observe(batch_size)
+    FORWARD_BATCHER.observe(seconds)
+
+
+def cache_lookup(img):
+    key, prob, source = prediction_cache.lookup(img)
+    CACHE_RESULTS[source].inc()
+    return key, prob
+
+
+def saved(future):
+    pending_saves.discard(future)
+    if not future.cancelled() and future.exception() is not None:
+        log_event("prediction_cache_save_failed", error=repr(future.exception()))
+
+
+def cache_store(key, prob):
+    # memory tier right away, disk tier off the request path (called from
+    # the event loop and from threadpool workers)
+    prediction_cache.remember(key, prob)
+    if cache_writer is not None:
+        future = cache_writer.submit(prediction_cache.save, key, prob)
+        pending_saves.add(future)
+        future.add_done_callback(saved)
+
+
+async def classify(img):
+    # prediction of one image, from the cache or through the batcher
+    if prediction_cache is None:
+        return await batcher.submit(img)
+    key, prob = await run_in_threadpool(cache_lookup, img)
+    if prob is None:
+        prob = await batcher.submit(img)
+        cache_store(key, prob)
+    return prob
+
+
+def forward_analyze(images):
+    with FORWARD_ANALYZE.time():
+        probs = served_model.predict(images)
+    BATCH_SIZE_ANALYZE.observe(len(images))
+    return probs
+
+
+def analyze_predict(images):
+    # forward pass of /analyze, which batches beats itself; only beats
+    # missing from the cache are run through the model
+    if prediction_cache is None:
+        return forward_analyze(images)
+    keys, probs = zip(*[cache_lookup(img) for img in images])
+    probs = list(probs)
+    missing = [i for i, prob in enumerate(probs) if prob is None]
+    if missing:
+        for i, prob in zip(missing, forward_analyze(images[missing])):
+            cache_store(keys[i], prob)
+            probs[i] = prob
+    return np.stack(probs)
+
+
+def describe_prediction(prob):
+    # prob: probabilities of a single image
     label_pred = prob.argmax(axis=-1)
-    res = CLASSES_TO_CHECK[label_pred[0]]
-    print("Probability: {}".format(prob))
-    print("Result: {}".format(res))
+    res = CLASSES_TO_CHECK[label_pred]
+    PREDICTIONS.labels(res).inc()
+    log_event("prediction", LOG_SAMPLE_RATE, label=res,
+              probabilities=[float(p) for p in prob])
     result_description = description[res]
     if res == "N":
         state = "Normal"
@@ -42,13 +310,33 @@ def predict(model, image):
     return_val = "{}.Result: {} with probability {}. {} means {} ".format(
         state,
         res,
-        prob[0][label_pred[0]],
+        prob[label_pred],
         res,
         result_description
     )
     return return_val
 
 
+def stream_result(session_id, peak, prob):
+    label_pred = int(prob.argmax(axis=-1))
+    res = CLASSES_TO_CHECK[label_pred]
+    PREDICTIONS.labels(res).inc()
+    return {
+        "session": session_id,
+        "sample": int(peak),
+        "label": res,
+        "probability": float(prob[label_pred]),
+        "description": description[res],
+    }
+
+
+def predict(model, image):
+    channels = model.input_shape[-1]
+    img = read_image(image, channels).reshape(1, 224, 224, channels)
+    prob = model.predict(img)
+    return describe_prediction(prob[0])
+
+
 def test_predict(img_folder: str):
     import os
     model_path = "/home/hieppm/hieppm/testing/model_weights/vgg16.h5"
@@ -60,10 +348,178 @@ def test_predict(img_folder: str):
         print(predict_res)
 
 
+@app.on_event("startup")
+async def load_served_model():
+    global served_model, model_load_seconds, batcher, image_channels, prediction_cache, \
+        cache_writer
+    setup_logging()
+    start = time.perf_counter()
+    model = load_model(MODEL_PATH, MODEL_BACKEND)
+    warm_up(model)
+    model_load_seconds = time.perf_counter() - start
+    MODEL_LOAD_SECONDS.set(model_load_seconds)
+    image_channels = model.input_shape[-1]
+    log_event("model_loaded", model_path=MODEL_PATH, backend=MODEL_BACKEND,
+              load_seconds=model_load_seconds)
+
+    batcher = MicroBatcher(model.predict, max_batch_size=BATCH_MAX_SIZE,
+                           max_delay=BATCH_MAX_DELAY_MS / 1000,
+                           on_batch=observe_batch)
+    batcher.start()
+    if PREDICTION_CACHE_SIZE > 0:
+        # cached predictions are only valid for the model they came from
+        model_version = os.environ.get("MODEL_VERSION") or file_version(MODEL_PATH)
+        prediction_cache = PredictionCache(PREDICTION_CACHE_SIZE, model_version,
+                                           PREDICTION_CACHE_DIR)
+        if PREDICTION_CACHE_DIR is not None:
+            cache_writer = ThreadPoolExecutor(1, thread_name_prefix="prediction_cache")
+        log_event("prediction_cache", max_entries=PREDICTION_CACHE_SIZE,
+                  disk_dir=PREDICTION_CACHE_DIR, model_version=model_version)
+    served_model = model
+
+
+@app.on_event("shutdown")
+async def stop_batcher():
+    if batcher is not None:
+        await batcher.stop()
+    if cache_writer is not None:
+        # finish pending writes of the disk tier
+        await run_in_threadpool(cache_writer.shutdown, True)
+    if log_listener is not None:
+        log_listener.stop()
+
+
+@app.middleware("http")
+async def record_request(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # route template, not raw path, keeps the number of series bounded
+        route = request.scope.get("route")
+        endpoint = route.path if route is not None else "unmatched"
+        seconds = time.perf_counter() - start
+        REQUESTS.labels(endpoint, status).inc()
+        REQUEST_SECONDS.labels(endpoint).observe(seconds)
+        log_event("request", LOG_SAMPLE_RATE, endpoint=endpoint,
+                  status=status, seconds=seconds)
+
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(registry.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/ready")
+def ready():
+    if served_model is None:
+        raise HTTPException(status_code=503, detail="Model is loading")
+    return {"ready": True, "model_path": MODEL_PATH, "backend": MODEL_BACKEND,
+            "load_seconds": model_load_seconds,
+            "prediction_cache": prediction_cache.stats() if prediction_cache is not None else None}
+
+
 @app.get("/")
-def image_pred(image_path):
-    model = load_model(MODEL_PATH)
-    return predict(model, image_path)
+async def image_pred(image_path):
+    if served_model is None:
+        raise HTTPException(status_code=503, detail="Model is loading")
+    img = await run_in_threadpool(read_image, image_path, image_channels)
+    prob = await classify(img)
+    return describe_prediction(prob)
+
+
+@app.post("/predict/image")
+async def image_bytes_pred(request: Request):
+    if served_model is None:
+        raise HTTPException(status_code=503, detail="Model is loading")
+    body = await request.body()
+    try:
+        img = await run_in_threadpool(decode_image, body, image_channels)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    prob = await classify(img)
+    return describe_prediction(prob)
+
+
+@app.post("/predict/signal")
+async def signal_pred(request: Request, dtype: str = "float32"):
+    if served_model is None:
+        raise HTTPException(status_code=503, detail="Model is loading")
+    body = await request.body()
+    try:
+        signal = decode_signal(body, dtype)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    img = await run_in_threadpool(signal_to_image, signal, image_channels)
+    prob = await classify(img)
+    return describe_prediction(prob)
+
+
+@app.post("/analyze")
+async def analyze_signal(request: Request, fs: int = 360, dtype: str = "float32"):
+    # whole recording: detect, segment and classify every beat in batches
+    if served_model is None:
+        raise HTTPException(status_code=503, detail="Model is loading")
+    if fs <= 0:
+        raise HTTPException(status_code=400, detail="fs must be positive")
+    body = await request.body()
+    try:
+        signal = decode_signal(body, dtype)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    result = await run_in_threadpool(
+        analysis.analyzeSignal, signal, fs, analyze_predict,
+        served_model.input_shape[-1])
+    for label, n in result["label_counts"].items():
+        PREDICTIONS.labels(label).inc(n)
+    return result
+
+
+async def classify_beat(peak, signal):
+    img = await run_in_threadpool(signal_to_image, signal, image_channels)
+    prob = await classify(img)
+    return peak, prob
+
+
+@app.websocket("/stream/{session_id}")
+async def stream_pred(websocket: WebSocket, session_id: str, fs: int = 360,
+                      dtype: str = "float32"):
+    # client sends binary frames of samples, every completed beat is
+    # classified and sent back as json
+    await websocket.accept()
+    if served_model is None:
+        await websocket.close(code=1013)
+        return
+    # one socket per session: a stream is not safe to push concurrently
+    if session_id in streams:
+        await websocket.close(code=1008, reason="Session is already open")
+        return
+    if len(streams) >= MAX_STREAM_SESSIONS:
+        await websocket.close(code=1013, reason="Too many open sessions")
+        return
+    stream = BeatStream(fs)
+    streams[session_id] = stream
+    try:
+        while True:
+            data = await websocket.receive_bytes()
+            try:
+                samples = decode_signal(data, dtype)
+            except ValueError as e:
+                await websocket.send_json({"session": session_id, "error": str(e)})
+                continue
+            beats = await run_in_threadpool(stream.push, samples)
+            results = await asyncio.gather(
+                *[classify_beat(peak, signal) for peak, signal in beats])
+            for peak, prob in results:
+                await websocket.send_json(stream_result(session_id, peak, prob))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if streams.get(session_id) is stream:
+            del streams[session_id]
 
 
 if __name__ == "__main__":
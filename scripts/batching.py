@@ -0,0 +1,87 @@
+import time
+import asyncio
+import numpy as np
+
+
+class MicroBatcher:
+    """
+    Collect inputs of concurrent requests and run them through the model
+    as one batch.
+
+    A batch is run as soon as it holds max_batch_size inputs or when
+    max_delay seconds have passed since its first input arrived. The model
+    runs in a worker thread so the event loop keeps accepting requests
+    while a batch is being computed.
+
+    on_batch, if given, is called with the size of every batch and the
+    seconds its forward pass took.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=32, max_delay=0.005,
+                 on_batch=None):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.on_batch = on_batch
+        self.queue = None
+        self.task = None
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def depth(self):
+        """
+        Number of inputs waiting for a batch.
+        """
+        return self.queue.qsize() if self.queue is not None else 0
+
+    async def submit(self, x):
+        """
+        Queue one input (without batch axis) and wait for its prediction.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((x, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            inputs = np.stack([x for x, _ in batch])
+            start = time.perf_counter()
+            try:
+                outputs = await loop.run_in_executor(None, self.predict_fn, inputs)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            if self.on_batch is not None:
+                self.on_batch(len(batch), time.perf_counter() - start)
+            for (_, future), output in zip(batch, outputs):
+                if not future.done():
+                    future.set_result(output)
@@ -0,0 +1,140 @@
+# This file draws heartbeats directly into grayscale image arrays. It
+# reproduces the geometry of the images saveSignal makes with matplotlib
+# (default figure, axis off, saved at 125 dpi, converted to grayscale and
+# resized to 224x224) without any figure state or disk round trip.
+
+import numpy as np
+
+IMAGE_SIZE = 224
+
+# matplotlib defaults used by saveSignal
+FIGURE_WIDTH = 6.4  # inches
+FIGURE_HEIGHT = 4.8  # inches
+DPI = 125
+AXES_LEFT = 0.125
+AXES_RIGHT = 0.9
+AXES_BOTTOM = 0.11
+AXES_TOP = 0.88
+AXES_MARGIN = 0.05
+LINE_WIDTH = 1.5  # points
+
+# grayscale value of the default line color (#1f77b4) and of the background
+LINE_INTENSITY = 100
+BACKGROUND_INTENSITY = 255
+
+# number of sub-columns sampled per output pixel column (anti-aliasing)
+SUPERSAMPLE = 4
+
+
+def getAxisLimits(low, high):
+    '''
+    Computes axis limits the way matplotlib autoscales a line plot
+
+    Args:
+            low (float): smallest data value
+
+            high (float): largest data value
+
+    Returns:
+            (tuple): lower and upper limit of axis
+    '''
+    if high - low == 0:
+        delta = 0.05 * abs(low) if low != 0 else 0.05
+        low, high = low - delta, high + delta
+
+    margin = AXES_MARGIN * (high - low)
+    return low - margin, high + margin
+
+
+def renderBeat(signal, image=None):
+    '''
+    Draws a single beat into a grayscale image array
+
+    Args:
+            signal (list): intensity values of beat to be drawn
+
+            image (numpy array): uint8 array of shape (IMAGE_SIZE, IMAGE_SIZE)
+            to draw into (optional)
+
+    Returns:
+            image (numpy array): uint8 array with beat drawn on it
+    '''
+    if image is None:
+        image = np.empty((IMAGE_SIZE, IMAGE_SIZE), dtype=np.uint8)
+    image.fill(BACKGROUND_INTENSITY)
+
+    y = np.asarray(signal, dtype=np.float64).reshape(-1)
+    if y.size == 0:
+        return image
+
+    # data limits as autoscaled by matplotlib
+    x_min, x_max = getAxisLimits(0, y.size - 1)
+    y_min, y_max = getAxisLimits(y.min(), y.max())
+
+    # position of samples in output pixel coordinates (row 0 at the top)
+    axes_left = AXES_LEFT * IMAGE_SIZE
+    axes_width = (AXES_RIGHT - AXES_LEFT) * IMAGE_SIZE
+    axes_top = (1 - AXES_TOP) * IMAGE_SIZE
+    axes_height = (AXES_TOP - AXES_BOTTOM) * IMAGE_SIZE
+    px = axes_left + (np.arange(y.size) - x_min) / (x_max - x_min) * axes_width
+    py = axes_top + (y_max - y) / (y_max - y_min) * axes_height
+
+    # half of line width in output pixels (the resize is not uniform)
+    half_width = LINE_WIDTH * DPI / 72 / 2
+    half_width_x = half_width * IMAGE_SIZE / (FIGURE_WIDTH * DPI)
+    half_width_y = half_width * IMAGE_SIZE / (FIGURE_HEIGHT * DPI)
+
+    # vertical extent of line in every sub-column, taken from line values
+    # at sub-column edges and from the samples falling inside the sub-column
+    columns = IMAGE_SIZE * SUPERSAMPLE
+    edges = np.arange(columns + 1) / SUPERSAMPLE
+    edge_values = np.interp(edges, px, py)
+    col_min = np.minimum(edge_values[:-1], edge_values[1:])
+    col_max = np.maximum(edge_values[:-1], edge_values[1:])
+
+    sample_cols = np.clip((px * SUPERSAMPLE).astype(np.int64), 0, columns - 1)
+    np.minimum.at(col_min, sample_cols, py)
+    np.maximum.at(col_max, sample_cols, py)
+
+    outside = (edges[1:] <= px[0]) | (edges[:-1] >= px[-1])
+    col_min[outside] = np.inf
+    col_max[outside] = -np.inf
+
+    # widen line horizontally by its half width
+    reach = int(round(half_width_x * SUPERSAMPLE))
+    for shift in range(1, reach + 1):
+        col_min[shift:] = np.minimum(col_min[shift:], col_min[:-shift])
+        col_min[:-shift] = np.minimum(col_min[:-shift], col_min[shift:])
+        col_max[shift:] = np.maximum(col_max[shift:], col_max[:-shift])
+        col_max[:-shift] = np.maximum(col_max[:-shift], col_max[shift:])
+
+    # fraction of every pixel row covered by line in each sub-column
+    low = col_min - half_width_y
+    high = col_max + half_width_y
+    rows = np.arange(IMAGE_SIZE, dtype=np.float64)[:, None]
+    coverage = np.clip(np.minimum(high, rows + 1) - np.maximum(low, rows), 0, 1)
+    coverage = coverage.reshape(IMAGE_SIZE, IMAGE_SIZE, SUPERSAMPLE).mean(axis=2)
+
+    pixels = BACKGROUND_INTENSITY - coverage * \
+        (BACKGROUND_INTENSITY - LINE_INTENSITY)
+    np.rint(pixels, out=pixels)
+    image[...] = pixels
+    return image
+
+
+def renderBeats(signals):
+    '''
+    Draws a batch of beats into grayscale image arrays
+
+    Args:
+            signals (list): list of beats (intensity values) to be drawn,
+            beats can have different lengths
+
+    Returns:
+            images (numpy array): uint8 array of shape
+            (number of beats, IMAGE_SIZE, IMAGE_SIZE)
+    '''
+    images = np.empty((len(signals), IMAGE_SIZE, IMAGE_SIZE), dtype=np.uint8)
+    for i, signal in enumerate(signals):
+        renderBeat(signal, images[i])
+    return images
@@ -0,0 +1,175 @@
+# This file reads and writes packed beat shards. A shard holds a run of
+# consecutive beats of one record as a single contiguous array (images or
+# signal windows) saved as .npy, plus an index with the record, beat number,
+# sample position and symbol of every beat. Shards can be memory mapped when
+# they are loaded.
+
+import os
+import numpy as np
+import directory_structure
+
+IMAGES_SUFFIX = '.images.npy'
+WINDOWS_SUFFIX = '.windows.npy'
+INDEX_SUFFIX = '.index.npy'
+
+SHARD_KINDS = {'images': IMAGES_SUFFIX, 'windows': WINDOWS_SUFFIX}
+
+INDEX_DTYPE = np.dtype([('record', np.int32), ('beat_number', np.int32),
+                        ('sample', np.int64), ('symbol', 'U1')])
+
+
+def getShardDirectory(kind):
+    '''
+    get path of directory where shards of specified kind are written
+
+    Args:
+            kind (str): kind of shard (images or windows)
+
+    Returns:
+            (str): path of shard directory
+    '''
+    return directory_structure.getWriteDirectory('beat_shard_dir', kind)
+
+
+def getShardName(record_name, first_beat):
+    '''
+    get name of the shard holding the beats of a record starting at first_beat
+
+    Args:
+            record_name (str): record number
+
+            first_beat (int): number of first beat in shard
+
+    Returns:
+            (str): name of shard (without suffix)
+    '''
+    return '{}_{:05d}'.format(record_name, int(first_beat))
+
+
+def getRecordShardNames(shard_dir, kind, record_name):
+    '''
+    get names of all shards of a record (complete or not)
+
+    Args:
+            shard_dir (str): directory where shards are present
+
+            kind (str): kind of shard (images or windows)
+
+            record_name (str): record number
+
+    Returns:
+            (list): sorted shard names
+    '''
+    names = set()
+    for suffix in [SHARD_KINDS[kind], INDEX_SUFFIX]:
+        for f in directory_structure.filesInDirectory(suffix, shard_dir):
+            name = f[:-len(suffix)]
+            if name.split('_')[0] == record_name:
+                names.add(name)
+    return sorted(names)
+
+
+def createIndex(record, beat_numbers, samples, symbols):
+    '''
+    build the index of a shard
+
+    Args:
+            record (int): record number beats belong to
+
+            beat_numbers (list): index of each beat in record
+
+            samples (list): sample position of each beat annotation
+
+            symbols (list): annotation symbol of each beat
+
+    Returns:
+            index (numpy array): structured array with one entry per beat
+    '''
+    index = np.empty(len(beat_numbers), dtype=INDEX_DTYPE)
+    index['record'] = record
+    index['beat_number'] = beat_numbers
+    index['sample'] = samples
+    index['symbol'] = symbols
+    return index
+
+
+def saveArray(path, array):
+    '''
+    save array as .npy file, replacing the file only once it is complete
+
+    Args:
+            path (str): path of .npy file
+
+            array (numpy array): array to save
+    '''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def writeShard(shard_dir, shard_name, kind, data, index):
+    '''
+    write beats and their index as a shard
+
+    Args:
+            shard_dir (str): directory to write shard to
+
+            shard_name (str): name of shard (without suffix)
+
+            kind (str): kind of shard (images or windows)
+
+            data (numpy array): beats, first axis is beat
+
+            index (numpy array): index created with createIndex
+    '''
+    if len(data) != len(index):
+        raise Exception(
+            "Number of beats in shard is different from number of index entries")
+
+    saveArray(os.path.join(shard_dir, shard_name + SHARD_KINDS[kind]),
+              np.ascontiguousarray(data))
+    saveArray(os.path.join(shard_dir, shard_name + INDEX_SUFFIX), index)
+
+
+def loadShard(shard_dir, shard_name, kind, mmap=True):
+    '''
+    load beats and index of a shard
+
+    Args:
+            shard_dir (str): directory where shard is present
+
+            shard_name (str): name of shard (without suffix)
+
+            kind (str): kind of shard (images or windows)
+
+            mmap (bool): memory map beats instead of reading them
+
+    Returns:
+            data (numpy array): beats of shard
+
+            index (numpy array): index of shard
+    '''
+    data = np.load(os.path.join(shard_dir, shard_name + SHARD_KINDS[kind]),
+                   mmap_mode='r' if mmap else None)
+    index = np.load(os.path.join(shard_dir, shard_name + INDEX_SUFFIX))
+    return data, index
+
+
+def getShardNames(shard_dir, kind):
+    '''
+    get names of all complete shards of specified kind in a directory
+
+    Args:
+            shard_dir (str): directory where shards are present
+
+            kind (str): kind of shard (images or windows)
+
+    Returns:
+            (list): sorted shard names
+    '''
+    suffix = SHARD_KINDS[kind]
+    data_files = directory_structure.filesInDirectory(suffix, shard_dir)
+    names = [f[:-len(suffix)] for f in data_files]
+    return sorted(name for name in names
+                  if os.path.exists(os.path.join(shard_dir, name + INDEX_SUFFIX)))
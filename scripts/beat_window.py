@@ -0,0 +1,32 @@
+# This file holds the window a beat is cut out of a signal with: from
+# BEAT_START_OFFSET samples before its QRS peak up to BEAT_END_OFFSET
+# samples before the next peak. It is shared by extraction (signal_api)
+# and the inference service (analysis, streaming) and imports nothing
+# heavy, so the service does not load the plotting stack.
+
+BEAT_START_OFFSET = 100
+BEAT_END_OFFSET = 100
+
+
+def sliceSignal(signal, sample_from, sample_to):
+    '''
+    Takes a window out of a signal that has already been read, using the
+    same bounds as getSignalInfo
+
+    Args:
+            signal (numpy array): samples of whole record
+
+            sample_from (int): start index of sample
+
+            sample_to (int): end index of sample
+
+    Returns:
+            (numpy array): samples of the window (view of signal)
+    '''
+    if sample_from < 0 and sample_to < 0:
+        sample_from = 0
+        sample_to = 60
+    elif sample_from < 0:
+        sample_from = 0
+
+    return signal[sample_from:sample_to]
@@ -0,0 +1,358 @@
+# This file benchmarks the stages of the pipeline on the MIT-BIH records in
+# mit-bih_waveform: reading records, QRS detection, drawing and saving beat
+# images, loading the training data set and model inference. Results are
+# written as one json document (with the commit they were measured on) so
+# runs on different commits can be compared.
+
+import os
+import io
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import resource
+import subprocess
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import wfdb
+import natsort
+import signal_api
+import beat_renderer
+import directory_structure
+
+STAGES = ['record_read', 'qrs_detection', 'beat_images', 'dataset', 'inference']
+
+# batch sizes inference latency is measured with
+BATCH_SIZES = [1, 8, 32]
+
+
+def getRecordPaths(records=None, num_records=None):
+    '''
+    get paths of records to benchmark on
+
+    Args:
+            records (list): record names to use (default all records)
+
+            num_records (int): use only the first num_records records
+
+    Returns:
+            (list): paths of records (without extension)
+    '''
+    signal_dir = directory_structure.getReadDirectory('mit-bih_waveform')
+    if not records:
+        records = natsort.natsorted(directory_structure.removeFileExtension(f)
+                                    for f in directory_structure.filesInDirectory('.hea', signal_dir))
+    if num_records is not None:
+        records = records[:num_records]
+    return [signal_dir + record for record in records]
+
+
+def summarizeTimes(times):
+    '''
+    summarize repeated timings (in seconds)
+
+    Returns:
+            (dict): number of runs and min, median, mean and p95 in seconds
+    '''
+    times = np.asarray(times, dtype=np.float64)
+    return {
+        'runs': len(times),
+        'min': float(times.min()),
+        'median': float(np.median(times)),
+        'mean': float(times.mean()),
+        'p95': float(np.percentile(times, 95)),
+    }
+
+
+def getPeakRSS():
+    # peak resident set size of this process in MB (ru_maxrss is in KB on
+    # linux and in bytes on mac)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak / 1024
+
+
+def runIsolated(function, *args):
+    '''
+    run a benchmark in a fresh process, so its peak memory is not mixed
+    with what earlier stages allocated
+    '''
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(1, mp_context=context) as executor:
+        return executor.submit(function, *args).result()
+
+
+def benchmarkRecordRead(record_paths, repeat):
+    '''
+    time reading whole records with getSignalInfo
+
+    Returns:
+            (dict): seconds per run and samples and megabytes read per second
+    '''
+    num_samples = 0
+    num_bytes = 0
+    times = []
+    for run in range(repeat):
+        start = time.perf_counter()
+        for record_path in record_paths:
+            signal, fields = signal_api.getSignalInfo(
+                record_path, 0, wfdb.rdheader(record_path).sig_len)
+            if run == 0:
+                num_samples += len(signal)
+                num_bytes += os.path.getsize(record_path + '.dat')
+        times.append(time.perf_counter() - start)
+
+    median = float(np.median(times))
+    return {
+        'records': len(record_paths),
+        'samples': num_samples,
+        'seconds': summarizeTimes(times),
+        'samples_per_second': num_samples / median,
+        'megabytes_per_second': num_bytes / median / 1e6,
+    }
+
+
+def benchmarkQRSDetection(record_paths, repeat):
+    '''
+    time XQRS (getXQRS) and GQRS (getQRSLocations) detection on whole
+    records
+
+    Returns:
+            (dict): seconds per run and samples per second of each detector
+    '''
+    signals = [signal_api.getRecordSignal(path) for path in record_paths]
+    num_samples = sum(len(signal) for signal, fields in signals)
+
+    detectors = {
+        'xqrs': lambda: [signal_api.getXQRS(signal, fields)
+                         for signal, fields in signals],
+        'gqrs': lambda: [signal_api.getQRSLocations(path) for path in record_paths],
+    }
+    result = {'records': len(record_paths), 'samples': num_samples}
+    for name, detect in detectors.items():
+        times = []
+        for run in range(repeat):
+            start = time.perf_counter()
+            # detectors print their progress
+            with contextlib.redirect_stdout(io.StringIO()):
+                detect()
+            times.append(time.perf_counter() - start)
+        result[name] = {
+            'seconds': summarizeTimes(times),
+            'samples_per_second': num_samples / float(np.median(times)),
+        }
+    return result
+
+
+def getBeats(record_paths, num_beats):
+    # first num_beats annotated beats of the records, cut out the way
+    # extraction does
+    beats = []
+    for record_path in record_paths:
+        ann = wfdb.rdann(record_path, 'atr')
+        record_signal, fields = signal_api.getRecordSignal(record_path)
+        for beat_number in signal_api.getBeatRange(ann):
+            if len(beats) == num_beats:
+                return beats
+            beats.append(signal_api.sliceSignal(
+                record_signal,
+                ann.sample[beat_number] - signal_api.BEAT_START_OFFSET,
+                ann.sample[beat_number + 1] - signal_api.BEAT_END_OFFSET))
+    return beats
+
+
+def benchmarkBeatImages(record_paths, num_beats):
+    '''
+    time drawing and saving beat images, with matplotlib (saveSignal) and
+    with beat_renderer (renderBeat and saveBeatImage)
+
+    Returns:
+            (dict): seconds and beats per second of each way of drawing
+    '''
+    beats = getBeats(record_paths, num_beats)
+    file_path = record_paths[0]
+    result = {'beats': len(beats)}
+
+    with tempfile.TemporaryDirectory() as wr_dir:
+        start = time.perf_counter()
+        for beat_number, signal in enumerate(beats):
+            signal_api.saveSignal(signal, beat_number, wr_dir, file_path)
+        seconds = time.perf_counter() - start
+        result['save_signal'] = {'seconds': seconds,
+                                 'beats_per_second': len(beats) / seconds}
+
+    with tempfile.TemporaryDirectory() as wr_dir:
+        start = time.perf_counter()
+        for beat_number, signal in enumerate(beats):
+            image = beat_renderer.renderBeat(signal)
+            signal_api.saveBeatImage(image, beat_number, wr_dir, file_path)
+        seconds = time.perf_counter() - start
+        result['beat_renderer'] = {'seconds': seconds,
+                                   'beats_per_second': len(beats) / seconds}
+
+    start = time.perf_counter()
+    beat_renderer.renderBeats(beats)
+    seconds = time.perf_counter() - start
+    result['render_only'] = {'seconds': seconds,
+                             'beats_per_second': len(beats) / seconds}
+    return result
+
+
+def benchmarkDataset(size_of_test_data):
+    '''
+    time loading the beat images of beat_write_dir with getSignalDataFrame
+    and splitting them with trainAndTestSplit, run it with runIsolated so
+    the peak memory is the one of loading the data set
+
+    Returns:
+            (dict): seconds of each step, number of beats and peak RSS in MB
+    '''
+    import cnn_model
+
+    baseline_rss = getPeakRSS()
+    start = time.perf_counter()
+    df, signals = cnn_model.getSignalDataFrame(return_array=True)
+    load_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    X_train, X_test, y_train, y_test = cnn_model.trainAndTestSplit(
+        df, size_of_test_data, signals=signals)
+    split_seconds = time.perf_counter() - start
+
+    return {
+        'beats': len(df),
+        'train_beats': len(X_train),
+        'test_beats': len(X_test),
+        'load_seconds': load_seconds,
+        'split_seconds': split_seconds,
+        'baseline_rss_mb': baseline_rss,
+        'peak_rss_mb': getPeakRSS(),
+    }
+
+
+def benchmarkInference(model_path, record_paths, repeat):
+    '''
+    time single image prediction of the service (app.predict, reading the
+    image from disk) and batched forward passes of the model (keras .h5 or
+    tflite model written by export_model.py)
+
+    Returns:
+            (dict): latency of single predictions and of each batch size
+    '''
+    import app
+
+    backend = 'tflite' if model_path.endswith('.tflite') else 'keras'
+    model = app.load_model(model_path, backend)
+    app.warm_up(model)
+    channels = model.input_shape[-1]
+
+    image = beat_renderer.renderBeat(getBeats(record_paths, 1)[0])
+    result = {'model': model_path}
+    with tempfile.TemporaryDirectory() as wr_dir:
+        signal_api.saveBeatImage(image, 0, wr_dir, record_paths[0])
+        image_path = os.path.join(wr_dir, os.listdir(wr_dir)[0])
+
+        times = []
+        for run in range(repeat):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                app.predict(model, image_path)
+            times.append(time.perf_counter() - start)
+        result['single'] = {'seconds': summarizeTimes(times)}
+
+    img = image[:, :, np.newaxis]
+    if channels > 1:
+        img = np.repeat(img, channels, axis=-1)
+    result['batched'] = {}
+    for batch_size in BATCH_SIZES:
+        batch = np.repeat(img[np.newaxis], batch_size, axis=0)
+        model.predict(batch)
+        times = []
+        for run in range(repeat):
+            start = time.perf_counter()
+            model.predict(batch)
+            times.append(time.perf_counter() - start)
+        median = float(np.median(times))
+        result['batched'][str(batch_size)] = {
+            'seconds': summarizeTimes(times),
+            'seconds_per_beat': median / batch_size,
+            'beats_per_second': batch_size / median,
+        }
+    return result
+
+
+def getCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+
+    args = argparse.ArgumentParser()
+    args.add_argument('--stages', type=str, nargs='*', default=STAGES, choices=STAGES,
+                      help='stages to benchmark')
+    args.add_argument('--records', type=str, nargs='*', default=None,
+                      help='record names to use (default all)')
+    args.add_argument('--num-records', type=int, default=5,
+                      help='use only the first records')
+    args.add_argument('--beats', type=int, default=500,
+                      help='number of beats drawn in beat_images stage')
+    args.add_argument('--repeat', type=int, default=3,
+                      help='number of runs of each timed step')
+    args.add_argument('--test-size', type=float, default=0.2,
+                      help='size of test data in dataset stage')
+    args.add_argument('--model', type=str, default='model/vgg16.h5',
+                      help='model used in inference stage')
+    args.add_argument('--output', type=str, default=None,
+                      help='write json result to this file instead of stdout')
+    args = args.parse_args()
+
+    record_paths = getRecordPaths(args.records, args.num_records)
+    if not record_paths:
+        raise Exception("No records found in mit-bih_waveform")
+
+    report = {
+        'commit': getCommit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'arguments': vars(args),
+        'results': {},
+    }
+    results = report['results']
+
+    for stage in args.stages:
+        print("Benchmarking", stage, file=sys.stderr)
+        if stage == 'record_read':
+            results[stage] = benchmarkRecordRead(record_paths, args.repeat)
+        elif stage == 'qrs_detection':
+            results[stage] = benchmarkQRSDetection(record_paths, args.repeat)
+        elif stage == 'beat_images':
+            results[stage] = benchmarkBeatImages(record_paths, args.beats)
+        elif stage == 'dataset':
+            beat_dir = os.getcwd() + '/../../beat_write_dir/'
+            if not os.path.isdir(beat_dir):
+                results[stage] = {'skipped': 'no beat images in ' + beat_dir}
+            else:
+                results[stage] = runIsolated(benchmarkDataset, args.test_size)
+        elif stage == 'inference':
+            if not os.path.exists(args.model):
+                results[stage] = {'skipped': 'no model at ' + args.model}
+            else:
+                results[stage] = benchmarkInference(
+                    args.model, record_paths, args.repeat)
+
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -2,11 +2,10 @@
 # https://www.mydatahack.com/building-alexnet-with-keras/
 # script that reads data, creates model and trains it
 
-from time import sleep
 from keras.models import Sequential
 from keras.layers import Dense, Activation, Dropout, Flatten,\
     Conv2D, MaxPooling2D
-from tensorflow.keras.layers import BatchNormalization
+from tensorflow.keras.layers import BatchNormalization, Rescaling
 import numpy as np
 import directory_structure
 import os
@@ -14,15 +13,22 @@ import cv2
 import pandas as pd
 from sklearn.model_selection import train_test_split
 import keras
-from collections import deque
-from keras.callbacks import EarlyStopping, ReduceLROnPlateau, ModelCheckpoint
-import tensorflow as tf
+from concurrent.futures import ThreadPoolExecutor
+from keras.callbacks import EarlyStopping
+import argparse
+import wfdb
 import models
+import beat_shards
+import signal_api
+import data_pipeline
 
 # classes model needs to learn to classify
 CLASSES_TO_CHECK = ['L', 'N', 'V', 'A', 'R']
 NUMBER_OF_CLASSES = len(CLASSES_TO_CHECK)
 IMAGES_TO_TRAIN = 2544  # total number images in class A
+IMAGE_CHANNELS = data_pipeline.IMAGE_CHANNELS  # 1: gray images, 3: BGR
+# models built by createModel rather than by models.MODEL_TRAINERS
+CREATED_MODELS = ['Alexnet', 'Novelnet']
 
 # removing warning for tensorflow about AVX support
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
@@ -63,67 +69,171 @@ def saveMetricsAndWeights(score, model, metric_name, model_name):
                   str((current_acc - highest_acc)*100) + '%')
 
 
-def getSignalDataFrame():
+def getSignalDataFrame(classes=CLASSES_TO_CHECK, images_per_class=IMAGES_TO_TRAIN,
+                       seed=0, workers=None, return_array=False):
     '''
         read signal images present in the directory beat_write_dir
-    and save them in a dataframe
+    and save them in a dataframe. Only images of the classes asked for are
+    read (at most images_per_class of each), in parallel threads, into one
+    uint8 array
+
+        Args:
+                classes (list): classes to read (None reads every class)
+
+        images_per_class (int): maximum number of images read per class
+                                (None reads all)
+
+        seed (int): seed of random choice of images in capped classes
+
+        workers (int): number of reading threads (default number of cpus)
+
+        return_array (bool): also return the uint8 array the Signal column
+                             holds views of (row i is image i of dataframe),
+                             see trainAndTestSplit
 
         Returns:
                 (dataframe): dataframe contatining image information 
         '''
-    # get paths for where signals are present
-    signal_path = directory_structure.getWriteDirectory('beat_write_dir', None)
-    print(f"Signal path: {signal_path}")
+    # path and class of every image, nothing is decoded yet
+    image_paths, class_types = data_pipeline.getImageIndex()
+    print("Number of images in beat_write_dir: {}".format(len(image_paths)))
+
+    if classes is None:
+        classes = sorted(set(class_types))
+    chosen = data_pipeline.capClasses(
+        class_types, classes, images_per_class, seed)
+    image_paths = image_paths[chosen]
+    class_types = class_types[chosen]
+    print("Number of images to read: {}".format(len(image_paths)))
+
+    images = np.empty((len(image_paths), data_pipeline.IMAGE_SIZE,
+                       data_pipeline.IMAGE_SIZE, IMAGE_CHANNELS), dtype=np.uint8)
+    read_flag = cv2.IMREAD_GRAYSCALE if IMAGE_CHANNELS == 1 else cv2.IMREAD_COLOR
+
+    def readImage(i):
+        img = cv2.imread(image_paths[i], read_flag)
+        if img is None:
+            raise Exception("Could not read image {}".format(image_paths[i]))
+        if img.shape[:2] != images.shape[1:3]:
+            img = cv2.resize(img, images.shape[2:0:-1])
+        images[i] = img.reshape(images.shape[1:])
+
+    # cv2 releases the GIL while decoding
+    with ThreadPoolExecutor(workers or os.cpu_count()) as executor:
+        list(executor.map(readImage, range(len(image_paths))))
 
-    # create dataframe
+    # save information in dataframe
     df = pd.DataFrame(columns=['Signal ID', 'Signal', 'Type'])
+    df['Signal ID'] = [directory_structure.removeFileExtension(
+        os.path.basename(path)) for path in image_paths]
+    df['Type'] = class_types
+    df['Signal'] = list(images)
+
+    if return_array:
+        return df, images
+    return df
+
+
+def getShardDataFrame(kind='images'):
+    '''
+        read beats from the packed shards present in the directory
+    beat_shard_dir (memory mapped) and save them in a dataframe
 
-    arrhythmia_classes = directory_structure.getAllSubfoldersOfFolder(
-        signal_path)
-    print(f"arrhythmia classes: {arrhythmia_classes}")
-
-    image_paths = deque()
-    image_ids = deque()
-    class_types = deque()
-    images = []
-
-    # get path for each image in classification folders
-    for classification in arrhythmia_classes:
-        classification_path = ''.join([signal_path, classification])
-        print(f"Classification path: {classification_path}")
-        image_list = directory_structure.filesInDirectory(
-            '.png', classification_path)
-        print(
-            "length of images in class {} is {}".format(classification_path, len(image_list)))
-        for beat_id in image_list:
-            image_ids.append(directory_structure.removeFileExtension(beat_id))
-            class_types.append(classification)
-            image_paths.append(''.join([classification_path, '/', beat_id]))
-
-    # read and save images in dataframe
-    for path in image_paths:
-        images.append(cv2.imread(path))
-
-    print(f"Class type: {class_types}")
+        Args:
+                kind (str): kind of shards to read (images or windows)
+
+        Returns:
+                (dataframe): dataframe contatining image information
+        '''
+    shard_dir = beat_shards.getShardDirectory(kind)
+    print(f"Shard path: {shard_dir}")
+
+    image_ids = []
+    class_types = []
+    signals = []
+
+    for shard_name in beat_shards.getShardNames(shard_dir, kind):
+        data, index = beat_shards.loadShard(shard_dir, shard_name, kind)
+        print("length of beats in shard {} is {}".format(shard_name, len(index)))
+
+        for i, entry in enumerate(index):
+            image_ids.append('image_{}_{}'.format(
+                entry['record'], entry['beat_number']))
+            class_types.append(str(entry['symbol']))
+            if kind == 'images':
+                # gray images are viewed with IMAGE_CHANNELS channels
+                # without copying
+                signals.append(np.broadcast_to(
+                    data[i][:, :, None], data.shape[1:] + (IMAGE_CHANNELS,)))
+            else:
+                signals.append(data[i])
 
     # save information in dataframe
+    df = pd.DataFrame(columns=['Signal ID', 'Signal', 'Type'])
     df['Signal ID'] = image_ids
     df['Type'] = class_types
-    df['Signal'] = images
+    df['Signal'] = signals
 
-    return df
+    # keep beats of each class together like the png class folders
+    return df.sort_values('Type', kind='stable').reset_index(drop=True)
 
 
-def normalizeData(X_train, X_test, y_train, y_test):
+def getBeatWindowDataFrame():
+    '''
+        read every record present in the directory mit-bih_waveform once,
+    cut its beats into fixed length signal windows and save them in a dataframe
+
+        Returns:
+                (dataframe): dataframe contatining signal window information
+        '''
+    signal_dir = directory_structure.getReadDirectory('mit-bih_waveform')
+    signal_files = sorted(
+        directory_structure.filesInDirectory('.hea', signal_dir))
+
+    image_ids = []
+    class_types = []
+    windows = []
+
+    for signal_file in signal_files:
+        signal_path = signal_dir + \
+            directory_structure.removeFileExtension(signal_file)
+        ann = wfdb.rdann(signal_path, 'atr')
+
+        data, index = signal_api.getRecordBeats(signal_path, ann, 'windows')
+        print("length of beats in record {} is {}".format(signal_file, len(index)))
+
+        for i, entry in enumerate(index):
+            image_ids.append('image_{}_{}'.format(
+                entry['record'], entry['beat_number']))
+            class_types.append(str(entry['symbol']))
+            windows.append(data[i])
+
+    # save information in dataframe
+    df = pd.DataFrame(columns=['Signal ID', 'Signal', 'Type'])
+    df['Signal ID'] = image_ids
+    df['Type'] = class_types
+    df['Signal'] = windows
+
+    # keep beats of each class together like the png class folders
+    return df.sort_values('Type', kind='stable').reset_index(drop=True)
+
+
+def normalizeData(X_train, X_test, y_train, y_test, images=True):
     '''
     Normalizing the test and train data
+
+    Images are kept as uint8, models scale them to [0, 1] in their first
+    layer, so no float copy of the whole dataset is made
+
+    Args:
+        images (bool): data are images rather than signal windows (already
+                       standardized, given a channel axis)
     '''
 
-    # image normalization
-    X_train = X_train.astype('float32')
-    X_train = X_train / 255
-    X_test = X_test.astype('float32')
-    X_test = X_test / 255
+    if not images:
+        # signal windows need a channel axis for 1D convolutions
+        X_train = X_train[..., np.newaxis]
+        X_test = X_test[..., np.newaxis]
 
     # label normalization
     y_train = keras.utils.to_categorical(y_train, NUMBER_OF_CLASSES)
@@ -132,14 +242,36 @@ def normalizeData(X_train, X_test, y_train, y_test):
     return X_train, X_test, y_train, y_test
 
 
-def convertToNumpy(X_train, X_test, y_train, y_test):
+def selectTrainTestIndices(types, size_of_test_data, seed=0):
     '''
-    Convert data arrays into numpy arrays
-    '''
-    return np.array(X_train), np.array(X_test), np.array(y_train), np.array(y_test)
+        choose at most IMAGES_TO_TRAIN beats of every class in
+    CLASSES_TO_CHECK and split them into train and test beats, stratified
+    by class
+
+        Args:
+                types (list): class of every beat
+
+        size_of_test_data (float): percentage of data specified for testing
+
+        seed (int): seed of class cap and split
+
+        Returns:
+                train_indexes (numpy array): positions of training beats
+
+        test_indexes (numpy array): positions of testing beats
+        '''
+    types = np.asarray(types).astype(str)
+    chosen = data_pipeline.capClasses(
+        types, CLASSES_TO_CHECK, IMAGES_TO_TRAIN, seed)
 
+    train_indexes, test_indexes = train_test_split(
+        chosen, test_size=size_of_test_data, stratify=types[chosen],
+        random_state=seed)
 
-def trainAndTestSplit(df, size_of_test_data):
+    return train_indexes, test_indexes
+
+
+def trainAndTestSplit(df, size_of_test_data, images=True, seed=0, signals=None):
     '''
         take dataframe and divide it into train and 
     test data for model training
@@ -147,11 +279,20 @@ def trainAndTestSplit(df, size_of_test_data):
         Args:
                 df (dataframe): dataframe with all images information
 
-        images_to_train (int): number of images to get for training
-                               from dataframe
-
         size_of_test_data (float): percentage of data specified for training
 
+        images (bool): dataframe holds images rather than signal windows
+
+        seed (int): seed of class cap and split
+
+        signals (numpy array): array of all beats of df (returned by
+                               getSignalDataFrame with return_array), indexed
+                               directly instead of stacking the Signal column
+
+        The split arrays are a copy of the chosen beats, callers should drop
+        df (and signals) once it is split so a single copy is kept while
+        training
+
         Returns:
                 X_train (list): list of training signals
 
@@ -161,73 +302,109 @@ def trainAndTestSplit(df, size_of_test_data):
 
         y_test (list): list of testing classes
         '''
-    image_count = 0
-    classes_to_check = CLASSES_TO_CHECK.copy()
-    images_available_in_class = IMAGES_TO_TRAIN
+    train_indexes, test_indexes = selectTrainTestIndices(
+        df['Type'].values, size_of_test_data, seed)
+
+    # class number of every beat
+    classes = pd.Categorical(
+        df['Type'].astype(str), categories=CLASSES_TO_CHECK).codes
+
+    # gather signals of chosen beats
+    if signals is None:
+        signals = np.asarray(df['Signal'].values)
+        X_train = np.stack(signals[train_indexes])
+        X_test = np.stack(signals[test_indexes])
+    else:
+        X_train = signals[train_indexes]
+        X_test = signals[test_indexes]
+    y_train = classes[train_indexes]
+    y_test = classes[test_indexes]
 
-    # train + test data (signals and classes of signals respectively)
-    X = []
-    y = []
+    # normalize data for easy data processing
+    X_train, X_test, y_train, y_test = normalizeData(
+        X_train, X_test, y_train, y_test, images)
 
-    for index, row in df.iterrows():
-        # check if current row is one of the classes to classify
-        if row['Type'] in classes_to_check:
-            images_available_in_class = df['Type'].value_counts()[row['Type']]
+    return X_train, X_test, y_train, y_test
 
-            X.append(row['Signal'])
-            y.append(CLASSES_TO_CHECK.index(str(row['Type'])))
 
-            image_count += 1
+def printTestMetrics(score):
+    '''
+    print prediction score
 
-            if images_available_in_class < IMAGES_TO_TRAIN:
-                if image_count == df['Type'].value_counts()[row['Type']]:
+    Args:
+        score (list): list with test loss and test accuracy
+    '''
+    print()
+    print('Test loss:', score[0])
+    print('Test accuracy:', score[1])
 
-                    image_count = 0
-                    classes_to_check.remove(row['Type'])
-            else:
-                if image_count == IMAGES_TO_TRAIN:
 
-                    image_count = 0
-                    classes_to_check.remove(row['Type'])
+def trainAndSaveModel(model_name, X_train, X_test, y_train, y_test,
+                      cache_features=False):
+    '''
+    train model chosen by name (see models.MODEL_TRAINERS), print its test
+    metrics and save its metrics and weights
 
-        # if data collected from all classes break loop
-        if len(classes_to_check) == 0:
-            break
+    Args:
+        model_name (str): name of model to train
 
-    # split x and y into train and test data
-    X_train, X_test, y_train, y_test = train_test_split(
-        X, y, test_size=size_of_test_data)
+        cache_features (bool): train head of frozen backbone models on
+                               cached backbone features
 
-    # convert to numpy array
-    X_train, X_test, y_train, y_test = convertToNumpy(
-        X_train, X_test, y_train, y_test)
+    Returns:
+        score (list): test loss and test accuracy
+    '''
+    kwargs = {}
+    if cache_features and model_name in models.FROZEN_BACKBONE_MODELS:
+        kwargs['cache_features'] = True
+
+    print("Training {} model".format(model_name))
+    if model_name in CREATED_MODELS:
+        model = trainCreatedModel(model_name, X_train, X_test, y_train, y_test,
+                                  batch_size=64, epochs=20)
+    else:
+        model = models.MODEL_TRAINERS[model_name](
+            X_train, y_train, X_test, y_test, batch_size=64, epochs=20,
+            num_classes=NUMBER_OF_CLASSES, output_file=model_name + ".h5", **kwargs)
 
-    # normalize data for easy data processing
-    X_train, X_test, y_train, y_test = normalizeData(
-        X_train, X_test, y_train, y_test)
+    score = model.evaluate(X_test, y_test, verbose=0)
 
-    return X_train, X_test, y_train, y_test
+    printTestMetrics(score)
 
+    saveMetricsAndWeights(score, model, model_name + ".npy", model_name + ".h5")
+    return score
 
-def printTestMetrics(score):
+
+def trainCreatedModel(model_name, X_train, X_test, y_train, y_test, batch_size, epochs):
     '''
-    print prediction score
+    build model with createModel, compile it and fit it on the training data
 
     Args:
-        score (list): list with test loss and test accuracy
+        model_name (str): Alexnet or Novelnet
+
+    Returns:
+        model (model): trained model
     '''
-    print()
-    print('Test loss:', score[0])
-    print('Test accuracy:', score[1])
+    model = createModel(model_name, models.input_shape_of(X_train)[-1])
+    model.compile(loss='categorical_crossentropy',
+                  optimizer='adam', metrics=['accuracy'])
+
+    early = EarlyStopping(monitor='val_loss', min_delta=0, patience=5,
+                          verbose=1, mode='auto', restore_best_weights=True)
+    models.fit_model(model, X_train, y_train, X_test, y_test,
+                     batch_size, epochs, [early])
+    return model
 
 
-def createModel(model_name):
+def createModel(model_name, channels=IMAGE_CHANNELS):
     '''
     Implementation of model to train images (Alexnet or Novelnet)
 
     Args:
         model_name (str): name of the model to create (can choose from Alexnet and Novelnet)
 
+        channels (int): number of channels of input images
+
     Returns:
         model (model): model object implementation of alexnet
     '''
@@ -235,7 +412,9 @@ def createModel(model_name):
 
     if model_name == 'Alexnet':
         # -----------------------1st Convolutional Layer--------------------------
-        model.add(Conv2D(filters=96, input_shape=(224, 224, 3), kernel_size=(11, 11),
+        # pixel values are scaled to [0, 1] inside the model
+        model.add(Rescaling(1. / 255, input_shape=(224, 224, channels)))
+        model.add(Conv2D(filters=96, kernel_size=(11, 11),
                          strides=(4, 4), padding='valid'))
         model.add(Activation('relu'))
         # Pooling
@@ -309,7 +488,9 @@ def createModel(model_name):
 
     elif model_name == 'Novelnet':
         # -----------------------1st Convolutional Layer--------------------------
-        model.add(Conv2D(filters=96, input_shape=(224, 224, 3), kernel_size=(13, 13),
+        # pixel values are scaled to [0, 1] inside the model
+        model.add(Rescaling(1. / 255, input_shape=(224, 224, channels)))
+        model.add(Conv2D(filters=96, kernel_size=(13, 13),
                          strides=(4, 4), padding='valid'))
         model.add(Activation('relu'))
         # Pooling
@@ -394,37 +575,73 @@ def createModel(model_name):
 if __name__ == '__main__':
     from utils import save_train_test_data
 
-    # (2) GET DATA
-    df = getSignalDataFrame()
-
-    X_train, X_test, y_train, y_test = trainAndTestSplit(df, 0.2)
-
-    # save train data from dataframe to image
-    save_train_test_data(X_train, y_train, data_type="train")
-    # save test data from dataframe to image
-    save_train_test_data(X_test, y_test, data_type="test")
-
-    # VGG16 model
-
-    print("Training VGG16 model")
-    vgg16_model = models.vgg16(
-        X_train, y_train, X_test, y_test, batch_size=64, epochs=20, num_classes=5, output_file="resnet152.h5")
-
-    predictions = vgg16_model.predict(X_test)
-    score = vgg16_model.evaluate(X_test, y_test, verbose=0)
-
-    printTestMetrics(score)
-
-    saveMetricsAndWeights(score, vgg16_model, "vgg16.npy", "vgg16.h5")
-
-    # VGG19 model
-    print("Training VGG16 model")
-    vgg19_model = models.vgg19(
-        X_train, y_train, X_test, y_test, batch_size=64, epochs=20, num_classes=5, output_file="resnet152.h5")
-
-    predictions = vgg19_model.predict(X_test)
-    score = vgg19_model.evaluate(X_test, y_test, verbose=0)
-
-    printTestMetrics(score)
-
-    saveMetricsAndWeights(score, vgg19_model, "vgg19.npy", "vgg19.h5")
+    args = argparse.ArgumentParser()
+    args.add_argument('--data-format', type=str, default='png', choices=['png', 'shard'],
+                      help='read beats from png images or from packed shards')
+    args.add_argument('--models', type=str, nargs='+', default=['vgg16', 'vgg19'],
+                      choices=sorted(models.MODEL_TRAINERS) + CREATED_MODELS,
+                      help='names of models to train')
+    args.add_argument('--cache-features', action='store_true',
+                      help='run frozen backbones once and train their heads on cached features')
+    args.add_argument('--pipeline', action='store_true',
+                      help='stream beats from disk with tf.data instead of loading them into memory')
+    args = args.parse_args()
+    if args.pipeline and args.cache_features:
+        raise Exception("--cache-features needs the beats in memory, it can not be "
+                        "combined with --pipeline")
+
+    image_models = [m for m in args.models if m not in models.SIGNAL_MODELS]
+    signal_models = [m for m in args.models if m in models.SIGNAL_MODELS]
+
+    if image_models and args.pipeline:
+        # beats are decoded from disk batch by batch while training
+        source = 'images' if args.data_format == 'shard' else 'png'
+        train_dataset, test_dataset = data_pipeline.trainAndTestDatasets(
+            source, 0.2, batch_size=64)
+
+        for model_name in image_models:
+            trainAndSaveModel(model_name, train_dataset, test_dataset, None, None)
+
+    elif image_models:
+        # (2) GET DATA
+        signals = None
+        if args.data_format == 'shard':
+            df = getShardDataFrame('images')
+        else:
+            df, signals = getSignalDataFrame(return_array=True)
+
+        X_train, X_test, y_train, y_test = trainAndTestSplit(
+            df, 0.2, signals=signals)
+        # the split holds its own copy of the beats, free the one of the
+        # dataframe before training
+        del df, signals
+
+        # save train data from dataframe to image
+        save_train_test_data(X_train, y_train, data_type="train")
+        # save test data from dataframe to image
+        save_train_test_data(X_test, y_test, data_type="test")
+
+        for model_name in image_models:
+            trainAndSaveModel(model_name, X_train, X_test, y_train, y_test,
+                              args.cache_features)
+
+    if signal_models and args.pipeline and args.data_format == 'shard':
+        train_dataset, test_dataset = data_pipeline.trainAndTestDatasets(
+            'windows', 0.2, batch_size=64)
+
+        for model_name in signal_models:
+            trainAndSaveModel(model_name, train_dataset, test_dataset, None, None)
+
+    elif signal_models:
+        # signal windows are cut straight from the records, no rendering
+        if args.data_format == 'shard':
+            df = getShardDataFrame('windows')
+        else:
+            df = getBeatWindowDataFrame()
+
+        X_train, X_test, y_train, y_test = trainAndTestSplit(
+            df, 0.2, images=False)
+        del df
+
+        for model_name in signal_models:
+            trainAndSaveModel(model_name, X_train, X_test, y_train, y_test)
@@ -0,0 +1,195 @@
+# This file builds tf.data input pipelines for training. Beats are streamed
+# from the png images in beat_write_dir or from the packed shards in
+# beat_shard_dir instead of being loaded into memory as one array: files
+# are decoded in parallel, shuffled with a bounded buffer, batched and
+# prefetched while the model trains. Images stay uint8, models scale them.
+
+import os
+import numpy as np
+import tensorflow as tf
+from sklearn.model_selection import train_test_split
+import directory_structure
+import beat_shards
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+CLASSES_TO_CHECK = ['L', 'N', 'V', 'A', 'R']
+IMAGES_TO_TRAIN = 2544  # total number images in class A
+IMAGE_SIZE = 224
+# beat images are gray, stored and loaded with a single channel
+IMAGE_CHANNELS = 1
+
+# number of beats held in shuffle buffer
+SHUFFLE_BUFFER = 2048
+
+
+def capClasses(labels, classes, images_per_class, seed):
+    '''
+    choose at most images_per_class beats of each class
+
+    Args:
+            labels (numpy array): class symbol of every beat
+
+            classes (list): classes to keep
+
+            images_per_class (int): maximum number of beats per class (None
+            keeps all)
+
+            seed (int): seed of random choice
+
+    Returns:
+            (numpy array): positions of chosen beats
+    '''
+    rng = np.random.RandomState(seed)
+    chosen = []
+    for classification in classes:
+        positions = np.flatnonzero(labels == classification)
+        if images_per_class is not None and len(positions) > images_per_class:
+            positions = rng.choice(positions, images_per_class, replace=False)
+        chosen.append(np.sort(positions))
+    return np.concatenate(chosen) if chosen else np.zeros(0, dtype=np.int64)
+
+
+def getImageIndex():
+    '''
+    get path and class of every png beat image in beat_write_dir
+
+    Returns:
+            paths (numpy array): paths of images
+
+            labels (numpy array): class of each image
+    '''
+    signal_path = directory_structure.getWriteDirectory('beat_write_dir', None)
+    paths = []
+    labels = []
+    for classification in directory_structure.getAllSubfoldersOfFolder(signal_path):
+        classification_path = os.path.join(signal_path, classification)
+        for beat_id in directory_structure.filesInDirectory('.png', classification_path):
+            paths.append(os.path.join(classification_path, beat_id))
+            labels.append(classification)
+    return np.array(paths), np.array(labels)
+
+
+def getShardIndex(kind):
+    '''
+    get shard and row of every beat in the shards of specified kind
+
+    Returns:
+            locations (numpy array): (shard number, row) of every beat
+
+            labels (numpy array): class of each beat
+
+            shard_paths (list): path of data file of each shard number
+    '''
+    shard_dir = beat_shards.getShardDirectory(kind)
+    locations = []
+    labels = []
+    shard_paths = []
+    for shard_number, shard_name in enumerate(beat_shards.getShardNames(shard_dir, kind)):
+        index = np.load(os.path.join(shard_dir, shard_name + beat_shards.INDEX_SUFFIX))
+        shard_paths.append(os.path.join(
+            shard_dir, shard_name + beat_shards.SHARD_KINDS[kind]))
+        rows = np.arange(len(index))
+        locations.append(np.stack([np.full(len(index), shard_number), rows], axis=1))
+        labels.append(index['symbol'].astype(str))
+    if not locations:
+        return np.zeros((0, 2), dtype=np.int64), np.zeros(0, dtype=str), shard_paths
+    return np.concatenate(locations), np.concatenate(labels), shard_paths
+
+
+def decodeImage(path):
+    # png decoded like cv2.imread (BGR when color), kept as uint8 (models
+    # scale it)
+    img = tf.io.decode_png(tf.io.read_file(path), channels=IMAGE_CHANNELS)
+    img = tf.image.resize(img, (IMAGE_SIZE, IMAGE_SIZE))
+    if IMAGE_CHANNELS == 3:
+        img = tf.reverse(img, axis=[-1])
+    return tf.cast(img, tf.uint8)
+
+
+def shardReader(shard_paths, kind):
+    '''
+    make a function reading one beat of a shard, shards are memory mapped
+    once and shared by all reader threads
+    '''
+    shards = {}
+
+    def readBeat(location):
+        shard_number, row = int(location[0]), int(location[1])
+        if shard_number not in shards:
+            shards[shard_number] = np.load(shard_paths[shard_number], mmap_mode='r')
+        beat = np.array(shards[shard_number][row])
+        if kind == 'images':
+            return np.repeat(beat[:, :, np.newaxis], IMAGE_CHANNELS, axis=-1)
+        return beat[:, np.newaxis]
+
+    return readBeat
+
+
+def makeDataset(items, labels, decode_fn, batch_size, shuffle, seed):
+    '''
+    build the pipeline: shuffle file list, decode in parallel, batch, prefetch
+    '''
+    one_hot = tf.keras.utils.to_categorical(labels, len(CLASSES_TO_CHECK))
+    dataset = tf.data.Dataset.from_tensor_slices((items, one_hot))
+    if shuffle:
+        dataset = dataset.shuffle(min(SHUFFLE_BUFFER, len(items)), seed=seed,
+                                  reshuffle_each_iteration=True)
+    dataset = dataset.map(lambda item, label: (decode_fn(item), label),
+                          num_parallel_calls=AUTOTUNE)
+    return dataset.batch(batch_size).prefetch(AUTOTUNE)
+
+
+def trainAndTestDatasets(source, size_of_test_data, batch_size, seed=0):
+    '''
+    build train and test pipelines with the classes in CLASSES_TO_CHECK,
+    each capped at IMAGES_TO_TRAIN beats and split stratified by class
+
+    Args:
+            source (str): 'png' (beat_write_dir images), 'images' or 'windows'
+            (shards of that kind)
+
+            size_of_test_data (float): percentage of data specified for testing
+
+            batch_size (int): number of beats in a batch
+
+            seed (int): seed of class cap, split and shuffling
+
+    Returns:
+            train_dataset (tf.data.Dataset): batches of (beats, one hot labels)
+
+            test_dataset (tf.data.Dataset): batches of (beats, one hot labels)
+    '''
+    if source == 'png':
+        items, labels = getImageIndex()
+        decode_fn = decodeImage
+    else:
+        items, labels, shard_paths = getShardIndex(source)
+        if not shard_paths:
+            raise Exception("No shards of {} found, extract with --format shard".format(source))
+        read_beat = shardReader(shard_paths, source)
+        if source == 'images':
+            shape = (IMAGE_SIZE, IMAGE_SIZE, IMAGE_CHANNELS)
+            dtype = tf.uint8
+        else:
+            shape = (np.load(shard_paths[0], mmap_mode='r').shape[1], 1)
+            dtype = tf.float32
+
+        def decode_fn(location):
+            beat = tf.numpy_function(read_beat, [location], dtype)
+            beat.set_shape(shape)
+            return beat
+
+    chosen = capClasses(labels, CLASSES_TO_CHECK, IMAGES_TO_TRAIN, seed)
+    items = items[chosen]
+    classes = np.array([CLASSES_TO_CHECK.index(c) for c in labels[chosen]])
+
+    train_items, test_items, train_classes, test_classes = train_test_split(
+        items, classes, test_size=size_of_test_data, stratify=classes,
+        random_state=seed)
+
+    train_dataset = makeDataset(train_items, train_classes, decode_fn,
+                                batch_size, True, seed)
+    test_dataset = makeDataset(test_items, test_classes, decode_fn,
+                               batch_size, False, seed)
+    return train_dataset, test_dataset
@@ -0,0 +1,312 @@
+# This file trains a small student model to copy a large trained teacher
+# (e.g. vgg16.h5 saved by saveMetricsAndWeights). The student learns from
+# the true classes and from the teacher's probabilities softened with a
+# temperature, on the same trainAndTestSplit data the teacher was trained
+# on. Accuracy, size and latency of student and teacher are reported side
+# by side.
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import optimizers
+from keras.models import Model, load_model
+from keras.layers import Input, Dense, Conv1D, Conv2D, MaxPooling1D, MaxPooling2D, \
+    GlobalAveragePooling1D, GlobalAveragePooling2D, BatchNormalization, Activation, \
+    Dropout, Rescaling
+from keras.callbacks import EarlyStopping, TensorBoard
+import directory_structure
+import cnn_model
+
+# softening of teacher probabilities
+TEMPERATURE = 4.0
+# weight of true class loss, the rest goes to teacher loss
+ALPHA = 0.1
+
+# batch sizes latency is measured with (single beat and whole record)
+LATENCY_BATCH_SIZES = [1, 256]
+
+
+def student_model(input_shape, num_classes, width=16):
+    """
+    Small convolutional network returning logits (no softmax), four
+    convolution blocks and global average pooling. Images (224, 224, c) get
+    2D convolutions, signal windows (length, 1) get 1D convolutions.
+
+    Parameters:
+        width (int): filters of first block, doubled every other block
+    """
+    inputs = Input(shape=input_shape)
+    images = len(input_shape) == 3
+
+    if images:
+        # pixel values are scaled to [0, 1] inside the model
+        x = Rescaling(1. / 255)(inputs)
+        x = Conv2D(width, 5, strides=2, padding='same', use_bias=False)(x)
+    else:
+        x = Conv1D(width, 7, padding='same', use_bias=False)(inputs)
+    x = BatchNormalization()(x)
+    x = Activation('relu')(x)
+
+    for filters in [width * 2, width * 4, width * 4]:
+        if images:
+            x = MaxPooling2D(2)(x)
+            x = Conv2D(filters, 3, padding='same', use_bias=False)(x)
+        else:
+            x = MaxPooling1D(2)(x)
+            x = Conv1D(filters, 3, padding='same', use_bias=False)(x)
+        x = BatchNormalization()(x)
+        x = Activation('relu')(x)
+
+    x = GlobalAveragePooling2D()(x) if images else GlobalAveragePooling1D()(x)
+    x = Dropout(0.2)(x)
+    logits = Dense(num_classes)(x)
+    return Model(inputs=inputs, outputs=logits)
+
+
+def soften(probs, temperature):
+    """
+    Teacher probabilities at a higher temperature: softmax(log(p) / T),
+    the same as dividing the teacher logits by T.
+    """
+    logits = np.log(np.clip(probs, 1e-7, 1.0)) / temperature
+    logits -= logits.max(axis=-1, keepdims=True)
+    soft = np.exp(logits)
+    return (soft / soft.sum(axis=-1, keepdims=True)).astype(np.float32)
+
+
+def pack_targets(hard, soft):
+    """
+    Keras passes one target array to the loss, so true classes (one hot)
+    and soft teacher targets are packed side by side.
+    """
+    return np.concatenate([hard.astype(np.float32), soft], axis=-1)
+
+
+def distillation_loss(num_classes, temperature=TEMPERATURE, alpha=ALPHA):
+    """
+    Loss on packed targets: alpha * cross entropy with the true classes +
+    (1 - alpha) * T^2 * cross entropy with the softened teacher
+    probabilities (T^2 keeps the gradients of both terms on the same scale).
+    """
+    def loss(y_true, logits):
+        hard = y_true[:, :num_classes]
+        soft = y_true[:, num_classes:]
+        hard_loss = tf.keras.losses.categorical_crossentropy(
+            hard, logits, from_logits=True)
+        soft_loss = tf.keras.losses.categorical_crossentropy(
+            soft, logits / temperature, from_logits=True)
+        return alpha * hard_loss + (1 - alpha) * temperature ** 2 * soft_loss
+
+    return loss
+
+
+def hard_accuracy(num_classes):
+    # accuracy against the true classes of packed targets
+    def accuracy(y_true, logits):
+        return tf.keras.metrics.categorical_accuracy(y_true[:, :num_classes], logits)
+
+    return accuracy
+
+
+def has_rescaling(model):
+    # Rescaling layer anywhere in the model, nested models included
+    for layer in model.layers:
+        if isinstance(layer, Rescaling):
+            return True
+        if hasattr(layer, 'layers') and has_rescaling(layer):
+            return True
+    return False
+
+
+def check_teacher(teacher, data):
+    """
+    Fail on a teacher that would give wrong soft targets for the beats:
+    input of another kind (images or windows), or an image model without
+    an in-model Rescaling, which was trained on beats scaled to [0, 1]
+    outside the model and can not be fed the uint8 beats.
+    """
+    if len(teacher.input_shape) != data.ndim:
+        raise Exception("Teacher takes input of shape {}, beats have shape {}".format(
+            teacher.input_shape, data.shape))
+    if data.ndim == 4 and not has_rescaling(teacher):
+        raise Exception("Teacher has no Rescaling layer, it expects beats scaled "
+                        "outside the model; retrain it with the current models")
+
+
+def adapt_channels(batch, channels):
+    """
+    Beats laid out for a model taking the given number of channels. Gray
+    beats are repeated (like GRAY2BGR in the service), beats with identical
+    channels keep the first one.
+    """
+    if batch.shape[-1] == channels:
+        return batch
+    if batch.shape[-1] == 1:
+        return np.repeat(batch, channels, axis=-1)
+    if channels == 1:
+        return batch[..., :1]
+    raise Exception("Can not feed beats with {} channels to a model taking {}".format(
+        batch.shape[-1], channels))
+
+
+def predict_in_batches(model, data, batch_size):
+    """
+    Probabilities of a model on the beats, converted to its channels batch
+    by batch so no converted copy of the whole data is made.
+    """
+    channels = model.input_shape[-1]
+    return np.concatenate([
+        model.predict(adapt_channels(data[start:start + batch_size], channels),
+                      batch_size=batch_size, verbose=0)
+        for start in range(0, len(data), batch_size)])
+
+
+def distill(teacher, train_data, train_labels, test_data, test_labels, batch_size,
+            epochs, num_classes, temperature=TEMPERATURE, alpha=ALPHA, width=16):
+    """
+    Train a student on the teacher's softened probabilities and the true
+    classes.
+
+    Returns:
+        the student with a softmax on top, compiled with categorical cross
+        entropy so it can be evaluated, saved and served like the other
+        models
+    """
+    check_teacher(teacher, train_data)
+    train_targets = pack_targets(train_labels, soften(
+        predict_in_batches(teacher, train_data, batch_size), temperature))
+    test_targets = pack_targets(test_labels, soften(
+        predict_in_batches(teacher, test_data, batch_size), temperature))
+
+    student = student_model(train_data.shape[1:], num_classes, width)
+    student.compile(loss=distillation_loss(num_classes, temperature, alpha),
+                    optimizer=optimizers.Adam(learning_rate=0.001),
+                    metrics=[hard_accuracy(num_classes)])
+
+    early = EarlyStopping(monitor='val_loss', min_delta=0, patience=5, verbose=1,
+                          mode='auto', restore_best_weights=True)
+    tbCallBack = TensorBoard(
+        log_dir='../graph/student', histogram_freq=0, write_graph=True, write_images=True)
+
+    student.fit(train_data, train_targets, batch_size=batch_size, epochs=epochs,
+                shuffle=True, validation_data=(test_data, test_targets),
+                callbacks=[early, tbCallBack])
+
+    # logits to probabilities for serving
+    probabilities = Activation('softmax')(student.output)
+    model_final = Model(inputs=student.input, outputs=probabilities)
+    model_final.compile(loss="categorical_crossentropy",
+                        optimizer=optimizers.Adam(learning_rate=0.001),
+                        metrics=["accuracy"])
+    return model_final
+
+
+def measure_latency(model, data, batch_size, repeat=10):
+    """
+    Median seconds per beat of predicting a batch of beats.
+    """
+    batch = adapt_channels(data[:batch_size], model.input_shape[-1])
+    model.predict(batch, batch_size=batch_size, verbose=0)
+    times = []
+    for run in range(repeat):
+        start = time.perf_counter()
+        model.predict(batch, batch_size=batch_size, verbose=0)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)) / len(batch)
+
+
+def compare(teacher, student, test_data, test_labels):
+    """
+    Accuracy, number of parameters and latency per beat of teacher and
+    student on the test data.
+    """
+    report = {}
+    for name, model in [("teacher", teacher), ("student", student)]:
+        probs = predict_in_batches(model, test_data, 64)
+        report[name] = {
+            "accuracy": float(np.mean(probs.argmax(axis=-1) == test_labels.argmax(axis=-1))),
+            "parameters": int(model.count_params()),
+            "seconds_per_beat": {str(b): measure_latency(model, test_data, b)
+                                 for b in LATENCY_BATCH_SIZES if b <= len(test_data)},
+        }
+    report["speedup"] = {
+        b: report["teacher"]["seconds_per_beat"][b] / report["student"]["seconds_per_beat"][b]
+        for b in report["student"]["seconds_per_beat"]}
+    report["parameter_ratio"] = report["teacher"]["parameters"] / report["student"]["parameters"]
+    report["accuracy_difference"] = report["student"]["accuracy"] - report["teacher"]["accuracy"]
+    return report
+
+
+if __name__ == '__main__':
+
+    args = argparse.ArgumentParser()
+    args.add_argument('--teacher', type=str, default=None,
+                      help='path of trained teacher (default testing/model_weights/vgg16.h5)')
+    args.add_argument('--name', type=str, default='student',
+                      help='name the student is saved under')
+    args.add_argument('--data-format', type=str, default='png', choices=['png', 'shard'],
+                      help='read beats from png images or from packed shards')
+    args.add_argument('--temperature', type=float, default=TEMPERATURE,
+                      help='softening of teacher probabilities')
+    args.add_argument('--alpha', type=float, default=ALPHA,
+                      help='weight of true class loss')
+    args.add_argument('--width', type=int, default=16,
+                      help='filters of first block of student')
+    args.add_argument('--epochs', type=int, default=30,
+                      help='number of training epochs')
+    args.add_argument('--batch-size', type=int, default=64,
+                      help='training batch size')
+    args = args.parse_args()
+
+    teacher_path = args.teacher
+    if teacher_path is None:
+        teacher_path = directory_structure.getWriteDirectory(
+            'testing', 'model_weights') + 'vgg16.h5'
+    teacher = load_model(teacher_path, compile=False)
+
+    # same data and split as the teacher
+    images = len(teacher.input_shape) == 4
+    signals = None
+    if images:
+        if args.data_format == 'shard':
+            df = cnn_model.getShardDataFrame('images')
+        else:
+            df, signals = cnn_model.getSignalDataFrame(return_array=True)
+    else:
+        if args.data_format == 'shard':
+            df = cnn_model.getShardDataFrame('windows')
+        else:
+            df = cnn_model.getBeatWindowDataFrame()
+    X_train, X_test, y_train, y_test = cnn_model.trainAndTestSplit(
+        df, 0.2, images=images, signals=signals)
+    # only the split is used from here on
+    del df, signals
+
+    student = distill(teacher, X_train, y_train, X_test, y_test, args.batch_size,
+                      args.epochs, cnn_model.NUMBER_OF_CLASSES, args.temperature,
+                      args.alpha, args.width)
+
+    score = student.evaluate(X_test, y_test, verbose=0)
+    cnn_model.printTestMetrics(score)
+    cnn_model.saveMetricsAndWeights(score, student, args.name + ".npy", args.name + ".h5")
+
+    report = compare(teacher, student, X_test, y_test)
+    report["teacher_path"] = teacher_path
+    report["temperature"] = args.temperature
+    report["alpha"] = args.alpha
+    metrics_path = directory_structure.getWriteDirectory('testing', 'accuracy_metrics')
+    with open(os.path.join(metrics_path, args.name + "_distillation.json"), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print("{:<10}{:>12}{:>14}".format("", "teacher", "student"))
+    print("{:<10}{:>12.4f}{:>14.4f}".format(
+        "accuracy", report["teacher"]["accuracy"], report["student"]["accuracy"]))
+    print("{:<10}{:>12}{:>14}".format(
+        "params", report["teacher"]["parameters"], report["student"]["parameters"]))
+    for b, speedup in report["speedup"].items():
+        print("{:<10}{:>11.2f}ms{:>12.2f}ms  ({:.1f}x faster per beat)".format(
+            "batch " + b, 1e3 * report["teacher"]["seconds_per_beat"][b],
+            1e3 * report["student"]["seconds_per_beat"][b], speedup))
@@ -0,0 +1,274 @@
+# This file converts a trained Keras model (.h5 written by models.py or
+# cnn_model.py) to a quantized TensorFlow Lite model for CPU inference.
+# int8 quantization is calibrated on a sample of extracted beats, float16
+# and dynamic range quantization need no calibration. The quantized model
+# is then compared with the float model on other beats and the accuracy
+# drift, agreement and latency of both are written as a json report next
+# to the exported model.
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+import cv2
+import tensorflow as tf
+from tensorflow import keras
+import data_pipeline
+from tflite_backend import TFLiteModel
+
+QUANTIZATIONS = ['int8', 'float16', 'dynamic']
+
+# beats of each class used to calibrate int8 quantization
+CALIBRATION_BEATS_PER_CLASS = 100
+# beats of each class used to compare quantized and float model
+EVALUATION_BEATS_PER_CLASS = 200
+
+
+def chooseBeats(labels, calibration_per_class, evaluation_per_class, seed=0):
+    '''
+    choose disjoint calibration and evaluation beats of every class in
+    CLASSES_TO_CHECK
+
+    Returns:
+            calibration (numpy array): positions of calibration beats
+
+            evaluation (numpy array): positions of evaluation beats
+    '''
+    calibration = data_pipeline.capClasses(
+        labels, data_pipeline.CLASSES_TO_CHECK, calibration_per_class, seed)
+    remaining = np.setdiff1d(np.arange(len(labels)), calibration)
+    evaluation = remaining[data_pipeline.capClasses(
+        labels[remaining], data_pipeline.CLASSES_TO_CHECK, evaluation_per_class, seed + 1)]
+    return calibration, evaluation
+
+
+def readImages(paths, channels):
+    # read png beat images the way the model is trained on them
+    read_flag = cv2.IMREAD_GRAYSCALE if channels == 1 else cv2.IMREAD_COLOR
+    images = np.empty((len(paths), data_pipeline.IMAGE_SIZE,
+                       data_pipeline.IMAGE_SIZE, channels), dtype=np.uint8)
+    for i, path in enumerate(paths):
+        img = cv2.imread(path, read_flag)
+        if img is None:
+            raise Exception("Could not read image {}".format(path))
+        img = cv2.resize(img, (data_pipeline.IMAGE_SIZE, data_pipeline.IMAGE_SIZE))
+        images[i] = img.reshape(images.shape[1:])
+    return images
+
+
+def readShardBeats(locations, shard_paths, kind, channels):
+    # read beats of shards, laid out like the training data
+    shards = {}
+    beats = []
+    for shard_number, row in locations:
+        if shard_number not in shards:
+            shards[shard_number] = np.load(shard_paths[shard_number], mmap_mode='r')
+        beats.append(np.array(shards[shard_number][row]))
+    beats = np.stack(beats)
+    if kind == 'windows':
+        return beats[..., np.newaxis]
+    return np.repeat(beats[..., np.newaxis], channels, axis=-1)
+
+
+def loadBeats(model, data_format, calibration_per_class, evaluation_per_class, seed=0):
+    '''
+    load calibration and evaluation beats shaped like the model input:
+    images for image models, signal windows (shards only) for cnn1d
+
+    Args:
+            model (model): keras model to export
+
+            data_format (str): read images from 'png' files or from 'shard's
+
+    Returns:
+            calibration (numpy array): calibration beats
+
+            evaluation (numpy array): evaluation beats
+
+            evaluation_classes (numpy array): class number of evaluation beats
+    '''
+    channels = model.input_shape[-1]
+    if len(model.input_shape) == 3:
+        kind = 'windows'
+    elif data_format == 'shard':
+        kind = 'images'
+    else:
+        kind = 'png'
+
+    if kind == 'png':
+        items, labels = data_pipeline.getImageIndex()
+    else:
+        items, labels, shard_paths = data_pipeline.getShardIndex(kind)
+    if len(items) == 0:
+        raise Exception("No beats found to calibrate and evaluate with")
+
+    calibration, evaluation = chooseBeats(
+        labels, calibration_per_class, evaluation_per_class, seed)
+    evaluation_classes = np.array([data_pipeline.CLASSES_TO_CHECK.index(c)
+                                   for c in labels[evaluation]])
+
+    if kind == 'png':
+        return (readImages(items[calibration], channels),
+                readImages(items[evaluation], channels), evaluation_classes)
+    return (readShardBeats(items[calibration], shard_paths, kind, channels),
+            readShardBeats(items[evaluation], shard_paths, kind, channels),
+            evaluation_classes)
+
+
+def convertModel(model, quantization, calibration=None):
+    '''
+    convert keras model to tflite
+
+    Args:
+            model (model): keras model
+
+            quantization (str): 'int8' (weights and activations, calibrated
+            on calibration beats), 'float16' (weights) or 'dynamic' (int8
+            weights, float activations)
+
+            calibration (numpy array): beats used to calibrate int8
+
+    Returns:
+            (bytes): tflite model
+    '''
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    if quantization == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        if calibration is None or len(calibration) == 0:
+            raise Exception("int8 quantization needs calibration beats")
+
+        def representativeDataset():
+            for beat in calibration:
+                yield [beat[np.newaxis].astype(np.float32)]
+
+        converter.representative_dataset = representativeDataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        # images are already uint8 pixels, they are passed in unchanged;
+        # probabilities stay float
+        if calibration.dtype == np.uint8:
+            converter.inference_input_type = tf.uint8
+        else:
+            converter.inference_input_type = tf.int8
+    elif quantization != 'dynamic':
+        raise Exception("Quantization must be in list {int8, float16, dynamic}")
+
+    return converter.convert()
+
+
+def measureLatency(predict_fn, beats, batch_size, repeat=20):
+    # median seconds per call of predict_fn on a batch of beats
+    batch = beats[:batch_size]
+    predict_fn(batch)
+    times = []
+    for run in range(repeat):
+        start = time.perf_counter()
+        predict_fn(batch)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def predictInBatches(predict_fn, beats, batch_size=32):
+    return np.concatenate([predict_fn(beats[start:start + batch_size])
+                           for start in range(0, len(beats), batch_size)])
+
+
+def compareModels(model, quantized, beats, classes):
+    '''
+    compare float and quantized model on the same beats
+
+    Returns:
+            (dict): accuracy of both models, how often they agree, difference
+            of their probabilities and latency per beat
+    '''
+    def floatPredict(batch):
+        return model.predict(batch, verbose=0)
+
+    float_probs = predictInBatches(floatPredict, beats)
+    quantized_probs = predictInBatches(quantized.predict, beats)
+    float_labels = float_probs.argmax(axis=-1)
+    quantized_labels = quantized_probs.argmax(axis=-1)
+    difference = np.abs(float_probs - quantized_probs)
+
+    report = {
+        'beats': len(beats),
+        'float_accuracy': float(np.mean(float_labels == classes)),
+        'quantized_accuracy': float(np.mean(quantized_labels == classes)),
+        'agreement': float(np.mean(float_labels == quantized_labels)),
+        'mean_probability_difference': float(difference.mean()),
+        'max_probability_difference': float(difference.max()),
+        'per_class': {},
+        'latency': {},
+    }
+    report['accuracy_drift'] = report['quantized_accuracy'] - report['float_accuracy']
+
+    for number, classification in enumerate(data_pipeline.CLASSES_TO_CHECK):
+        mask = classes == number
+        if mask.any():
+            report['per_class'][classification] = {
+                'beats': int(mask.sum()),
+                'float_accuracy': float(np.mean(float_labels[mask] == number)),
+                'quantized_accuracy': float(np.mean(quantized_labels[mask] == number)),
+            }
+
+    for batch_size in [1, 32]:
+        if len(beats) < batch_size:
+            continue
+        float_seconds = measureLatency(floatPredict, beats, batch_size)
+        quantized_seconds = measureLatency(quantized.predict, beats, batch_size)
+        report['latency'][str(batch_size)] = {
+            'float_seconds_per_beat': float_seconds / batch_size,
+            'quantized_seconds_per_beat': quantized_seconds / batch_size,
+            'speedup': float_seconds / quantized_seconds,
+        }
+    return report
+
+
+if __name__ == '__main__':
+
+    args = argparse.ArgumentParser()
+    args.add_argument('--model', type=str, required=True,
+                      help='path of trained keras model (.h5)')
+    args.add_argument('--quantization', type=str, default='int8', choices=QUANTIZATIONS,
+                      help='int8 (calibrated), float16 or dynamic range')
+    args.add_argument('--output', type=str, default=None,
+                      help='path of tflite model (default <model>.<quantization>.tflite)')
+    args.add_argument('--data-format', type=str, default='png', choices=['png', 'shard'],
+                      help='read beats from png images or from packed shards')
+    args.add_argument('--calibration-beats', type=int, default=CALIBRATION_BEATS_PER_CLASS,
+                      help='beats of each class used to calibrate int8')
+    args.add_argument('--evaluation-beats', type=int, default=EVALUATION_BEATS_PER_CLASS,
+                      help='beats of each class used to compare the models')
+    args.add_argument('--seed', type=int, default=0,
+                      help='seed of choice of beats')
+    args = args.parse_args()
+
+    output = args.output
+    if output is None:
+        output = os.path.splitext(args.model)[0] + '.' + args.quantization + '.tflite'
+
+    model = keras.models.load_model(args.model, compile=False)
+    calibration, evaluation, evaluation_classes = loadBeats(
+        model, args.data_format, args.calibration_beats, args.evaluation_beats, args.seed)
+
+    tflite_model = convertModel(model, args.quantization, calibration)
+    with open(output, 'wb') as f:
+        f.write(tflite_model)
+
+    report = {
+        'model': args.model,
+        'output': output,
+        'quantization': args.quantization,
+        'float_size_bytes': os.path.getsize(args.model),
+        'quantized_size_bytes': os.path.getsize(output),
+        'calibration_beats': len(calibration) if args.quantization == 'int8' else 0,
+    }
+    report.update(compareModels(model, TFLiteModel(output), evaluation,
+                                evaluation_classes))
+
+    with open(output + '.json', 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
@@ -1,20 +1,78 @@
 # File to save images of beats in a specified directory
 
 import os
+import sys
+import time
 import wfdb
 import argparse
+import functools
 import signal_api
 import directory_structure
+import extraction_manifest
+import profiling
 import natsort  # module used to sort file names
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+# number of beats extracted by one task, records are split in chunks of
+# beats so long records are spread over all workers
+CHUNK_SIZE = 256
 
-def process_signal(signal_path):
+
+@functools.lru_cache(maxsize=2)
+def read_record(signal_path):
+    # chunks are submitted in record order, so a worker mostly gets chunks
+    # of the record it has just read and reads each record only once
+    record_signal, fields = signal_api.getRecordSignal(signal_path)
+    profiling.count('records_read')
+    return record_signal
+
+
+def read_annotations(signal_path):
     # get annotation data frame of signal file
-    ann = wfdb.rdann(signal_path, 'atr', return_label_elements=[
-        'symbol', 'description', 'label_store'], summarize_labels=True)
+    with profiling.stage('rdann'):
+        return wfdb.rdann(signal_path, 'atr', return_label_elements=[
+            'symbol', 'description', 'label_store'], summarize_labels=True)
+
+
+def process_chunk(signal_path, ann, first_beat, last_beat, output_format='png'):
+    # save beats first_beat to last_beat - 1 of a record, runs in a worker,
+    # returns the stage timings of the chunk if profiling is on
+    start = time.perf_counter()
+    record_signal = read_record(signal_path)
     # uncomment to save images of beats
-    signal_api.extractBeatsFromPatient(signal_path, ann)
+    if output_format == 'png':
+        num_beats = signal_api.extractBeatsFromPatient(
+            signal_path, ann, first_beat, last_beat, record_signal)
+    else:
+        num_beats = signal_api.extractBeatsToShard(
+            signal_path, ann, output_format, first_beat, last_beat, record_signal)
+    elapsed = time.perf_counter() - start
+    return os.getpid(), num_beats, elapsed, profiling.takeSnapshot()
+
+
+def prepare_record(signal_path, output_format='png', force=False):
+    # decide if a record has to be extracted, returns its annotations and
+    # the hashes of its files, or None if it is up to date
+    with profiling.stage('hash_record'):
+        hashes = extraction_manifest.getRecordHashes(signal_path)
+    if not force and extraction_manifest.isUpToDate(signal_path, output_format, hashes):
+        return None
+
+    # remove what an older or interrupted run left of this record
+    record_name = extraction_manifest.getRecordName(signal_path)
+    extraction_manifest.removeRecordOutputs(record_name, output_format)
+    return read_annotations(signal_path), hashes
+
+
+def print_report(workers, total_beats, failures, skipped, elapsed):
+    for pid in sorted(workers):
+        beats, busy = workers[pid]
+        print("worker {}: {} beats in {:.1f}s ({:.1f} beats/sec)".format(
+            pid, beats, busy, beats / busy if busy > 0 else 0.0))
+    print("total: {} beats in {:.1f}s ({:.1f} beats/sec), {} records up to date".format(
+        total_beats, elapsed, total_beats / elapsed if elapsed > 0 else 0.0, skipped))
+    for signal_path, first_beat, error in failures:
+        print("failed: beats from {} of {}: {!r}".format(first_beat, signal_path, error))
 
 
 if __name__ == '__main__':
@@ -22,9 +80,25 @@ if __name__ == '__main__':
     args = argparse.ArgumentParser()
     args.add_argument('--cpu', type=int, default=12,
                       help='number of cpu to use')
+    args.add_argument('--format', type=str, default='png',
+                      choices=['png', 'images', 'windows'],
+                      help='write one png per beat or shards of images/windows')
+    args.add_argument('--force', action='store_true',
+                      help='extract all records again, even if they are up to date')
+    args.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                      help='number of beats extracted by one task')
+    args.add_argument('--profile', action='store_true',
+                      help='time the stages of extraction and print a report '
+                      '(same as PROFILE_EXTRACTION=1)')
 
     args = args.parse_args()
     cpu = args.cpu
+    output_format = args.format
+    force = args.force
+    chunk_size = args.chunk_size
+    # before the pool starts so workers time their stages too
+    if args.profile:
+        profiling.enable()
 
     # find directory where data is
     signal_dir = directory_structure.getReadDirectory('mit-bih_waveform')
@@ -35,11 +109,73 @@ if __name__ == '__main__':
     # sort file names in ascending order in list
     signal_files = natsort.natsorted(signal_files)
 
+    start = time.perf_counter()
+    # chunks still running and number of beats of each record
+    pending = {}
+    records = {}
+    failures = []
+    skipped = 0
+    workers = {}
+    total_beats = 0
+    profile = {}
+
     # extract and save beats from file provided
-    with ProcessPoolExecutor(cpu) as executor:
+    with ProcessPoolExecutor(cpu, initializer=profiling.reset) as executor:
+        futures = {}
         for signal_file in signal_files:
             signal_path = signal_dir + \
                 directory_structure.removeFileExtension(signal_file)
 
-            # get annotation data frame of signal file
-            executor.submit(process_signal, signal_path)
+            try:
+                prepared = prepare_record(signal_path, output_format, force)
+            except Exception as e:
+                failures.append((signal_path, 0, e))
+                continue
+            if prepared is None:
+                skipped += 1
+                continue
+            ann, hashes = prepared
+
+            beat_numbers = signal_api.getBeatRange(ann)
+            records[signal_path] = (len(beat_numbers), hashes)
+            pending[signal_path] = 0
+            for first_beat in range(0, len(beat_numbers), chunk_size):
+                future = executor.submit(process_chunk, signal_path, ann, first_beat,
+                                         first_beat + chunk_size, output_format)
+                futures[future] = (signal_path, first_beat)
+                pending[signal_path] += 1
+            if pending[signal_path] == 0:
+                extraction_manifest.writeManifest(signal_path, output_format, 0, hashes)
+
+        for future in as_completed(futures):
+            signal_path, first_beat = futures[future]
+            pending[signal_path] -= 1
+            try:
+                pid, num_beats, busy, snapshot = future.result()
+            except Exception as e:
+                failures.append((signal_path, first_beat, e))
+                records.pop(signal_path, None)
+                continue
+
+            beats, time_busy = workers.get(pid, (0, 0.0))
+            workers[pid] = (beats + num_beats, time_busy + busy)
+            total_beats += num_beats
+            profiling.mergeSnapshot(profile, snapshot)
+
+            # record is complete once all of its chunks are saved, records
+            # with a failed chunk get no manifest and are extracted next run
+            if pending[signal_path] == 0 and signal_path in records:
+                num_record_beats, hashes = records.pop(signal_path)
+                extraction_manifest.writeManifest(
+                    signal_path, output_format, num_record_beats, hashes)
+                print(signal_path, "extracted")
+
+    elapsed = time.perf_counter() - start
+    print_report(workers, total_beats, failures, skipped, elapsed)
+    if profiling.enabled:
+        # stages run in this process (hashing, annotations)
+        profiling.mergeSnapshot(profile, profiling.takeSnapshot())
+        print(profiling.formatReport(profile, elapsed))
+    if failures:
+        # partial extraction, let cron and callers notice
+        sys.exit(1)
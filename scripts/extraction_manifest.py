@@ -0,0 +1,221 @@
+# This file keeps a manifest for every record extracted by
+# extract_heartbeat.py. A manifest holds the hashes of the record files,
+# the parameters beats were extracted with and the number of beats written.
+# It is written only after all beats of the record are saved, so a record
+# without an up to date manifest (new, changed or interrupted) is extracted
+# again and records whose manifest still matches are skipped.
+
+import os
+import glob
+import json
+import hashlib
+import directory_structure
+import signal_api
+import beat_renderer
+import beat_shards
+
+# files of a record the extracted beats depend on
+RECORD_EXTENSIONS = ['.hea', '.dat', '.atr']
+
+MANIFEST_SUFFIX = '.json'
+
+# bump when the way beats are extracted changes without a parameter changing
+MANIFEST_VERSION = 2
+
+
+def getManifestDirectory(output_format):
+    '''
+    get path of directory where manifests of specified output format are
+    written
+
+    Args:
+            output_format (str): 'png', 'images' or 'windows'
+
+    Returns:
+            (str): path of manifest directory
+    '''
+    return directory_structure.getWriteDirectory('beat_manifests', output_format)
+
+
+def hashFile(path, block_size=1 << 20):
+    '''
+    compute sha256 of a file, reading it in blocks
+
+    Args:
+            path (str): path of file
+
+            block_size (int): number of bytes read at once
+
+    Returns:
+            (str): hex digest of file
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def getRecordHashes(file_path):
+    '''
+    hash the files of a record
+
+    Args:
+            file_path (str): path of record (without extension)
+
+    Returns:
+            (dict): sha256 of each file of record present, by extension
+    '''
+    hashes = {}
+    for extension in RECORD_EXTENSIONS:
+        path = file_path + extension
+        if os.path.exists(path):
+            hashes[extension] = hashFile(path)
+    return hashes
+
+
+def getExtractionParameters(output_format):
+    '''
+    get the parameters that decide what beats are written for an output
+    format, a change to any of them makes existing outputs stale
+
+    Args:
+            output_format (str): 'png', 'images' or 'windows'
+
+    Returns:
+            (dict): extraction parameters
+    '''
+    parameters = {
+        'version': MANIFEST_VERSION,
+        'format': output_format,
+        'beat_start_offset': signal_api.BEAT_START_OFFSET,
+        'beat_end_offset': signal_api.BEAT_END_OFFSET,
+    }
+    if output_format == 'windows':
+        parameters['window_length'] = signal_api.WINDOW_LENGTH
+    else:
+        parameters['image_size'] = beat_renderer.IMAGE_SIZE
+        parameters['use_beat_renderer'] = signal_api.USE_BEAT_RENDERER
+    return parameters
+
+
+def getRecordName(file_path):
+    return signal_api.getNumbersFromString(os.path.basename(file_path))[0]
+
+
+def getManifestPath(record_name, output_format):
+    return os.path.join(getManifestDirectory(output_format),
+                        record_name + MANIFEST_SUFFIX)
+
+
+def loadManifest(record_name, output_format):
+    '''
+    load manifest of a record
+
+    Returns:
+            (dict): manifest, None if record has no (readable) manifest
+    '''
+    try:
+        with open(getManifestPath(record_name, output_format)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def writeManifest(file_path, output_format, num_beats, hashes=None):
+    '''
+    write manifest of a record once all of its beats are saved
+
+    Args:
+            file_path (str): path of record (without extension)
+
+            output_format (str): 'png', 'images' or 'windows'
+
+            num_beats (int): number of beats written
+
+            hashes (dict): hashes of record files (computed if not given)
+    '''
+    record_name = getRecordName(file_path)
+    manifest = {
+        'record': record_name,
+        'sources': getRecordHashes(file_path) if hashes is None else hashes,
+        'parameters': getExtractionParameters(output_format),
+        'num_beats': int(num_beats),
+        # files written, png images or shard files (one data and one index
+        # file per chunk of beats)
+        'num_outputs': len(getRecordOutputs(record_name, output_format)),
+    }
+    path = getManifestPath(record_name, output_format)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def removeManifest(record_name, output_format):
+    path = getManifestPath(record_name, output_format)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def getRecordOutputs(record_name, output_format):
+    '''
+    get paths of all files written for a record
+
+    Args:
+            record_name (str): record number
+
+            output_format (str): 'png', 'images' or 'windows'
+
+    Returns:
+            (list): paths of png images or shard files of record
+    '''
+    if output_format == 'png':
+        beat_dir = directory_structure.getWriteDirectory('beat_write_dir', None)
+        return glob.glob(os.path.join(beat_dir, '*', 'image_' + record_name + '_*.png'))
+
+    shard_dir = beat_shards.getShardDirectory(output_format)
+    paths = []
+    for shard_name in beat_shards.getRecordShardNames(shard_dir, output_format, record_name):
+        for suffix in [beat_shards.SHARD_KINDS[output_format], beat_shards.INDEX_SUFFIX]:
+            paths.append(os.path.join(shard_dir, shard_name + suffix))
+    return [path for path in paths if os.path.exists(path)]
+
+
+def removeRecordOutputs(record_name, output_format):
+    '''
+    remove manifest and all files written for a record, so nothing of an
+    older or interrupted extraction is left behind
+    '''
+    removeManifest(record_name, output_format)
+    for path in getRecordOutputs(record_name, output_format):
+        os.remove(path)
+
+
+def isUpToDate(file_path, output_format, hashes=None):
+    '''
+    check if a record was extracted from the same files with the same
+    parameters and all of its outputs are still present
+
+    Args:
+            file_path (str): path of record (without extension)
+
+            output_format (str): 'png', 'images' or 'windows'
+
+            hashes (dict): hashes of record files (computed if not given)
+
+    Returns:
+            (bool): True if record does not need to be extracted again
+    '''
+    record_name = getRecordName(file_path)
+    manifest = loadManifest(record_name, output_format)
+    if manifest is None:
+        return False
+    if hashes is None:
+        hashes = getRecordHashes(file_path)
+    if manifest.get('sources') != hashes or \
+            manifest.get('parameters') != getExtractionParameters(output_format):
+        return False
+
+    outputs = getRecordOutputs(record_name, output_format)
+    return len(outputs) == manifest.get('num_outputs')
@@ -0,0 +1,283 @@
+import abc
+import math
+import time
+import threading
+
+# default latency buckets (seconds)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = ['{}="{}"'.format(name, str(value).replace("\\", "\\\\")
+                                .replace('"', '\\"').replace("\n", "\\n"))
+               for name, value in pairs]
+    return "{" + ",".join(escaped) + "}"
+
+
+class Timer:
+    """
+    Context manager observing the time spent in its block.
+    """
+
+    def __init__(self, observe):
+        self.observe = observe
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Metric(abc.ABC):
+    """
+    Base of all metrics: a name, a help text and optional labels. A metric
+    with labels holds one child per combination of label values.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError("{} expects labels {}".format(
+                self.name, self.labelnames))
+        values = tuple(str(v) for v in values)
+        with self.lock:
+            child = self.children.get(values)
+            if child is None:
+                child = self.children[values] = self.new_child()
+            return child
+
+    def default(self):
+        # metric without labels has a single child
+        if self.labelnames:
+            raise ValueError("{} has labels, use labels()".format(self.name))
+        return self.labels()
+
+    @abc.abstractmethod
+    def new_child(self):
+        """
+        New child holding the value of one combination of label values.
+        """
+
+    @abc.abstractmethod
+    def samples(self):
+        """
+        Yield (sample name, formatted labels, value) of every child.
+        """
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+        for name, labels, value in self.samples():
+            lines.append("{}{} {}".format(name, labels, format_value(value)))
+        return lines
+
+
+class CounterChild:
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        if amount < 0:
+            raise ValueError("Counters can only increase")
+        with self.lock:
+            self.value += amount
+
+
+class Counter(Metric):
+    """
+    Value that only goes up, e.g. number of requests.
+    """
+
+    kind = "counter"
+
+    def new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self.default().inc(amount)
+
+    def samples(self):
+        with self.lock:
+            children = list(self.children.items())
+        for values, child in children:
+            yield (self.name + "_total",
+                   format_labels(self.labelnames, values), child.value)
+
+
+class GaugeChild:
+
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+        self.lock = threading.Lock()
+
+    def set(self, value):
+        with self.lock:
+            self.value = float(value)
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        # value is read from function when metrics are rendered
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            return float(self.function())
+        return self.value
+
+
+class Gauge(Metric):
+    """
+    Value that goes up and down, e.g. queue depth.
+    """
+
+    kind = "gauge"
+
+    def new_child(self):
+        return GaugeChild()
+
+    def set(self, value):
+        self.default().set(value)
+
+    def inc(self, amount=1):
+        self.default().inc(amount)
+
+    def dec(self, amount=1):
+        self.default().dec(amount)
+
+    def set_function(self, function):
+        self.default().set_function(function)
+
+    def samples(self):
+        with self.lock:
+            children = list(self.children.items())
+        for values, child in children:
+            yield self.name, format_labels(self.labelnames, values), child.get()
+
+
+class HistogramChild:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.sum += value
+            self.count += 1
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    def time(self):
+        return Timer(self.observe)
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values in cumulative buckets, e.g. latency.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), registry=None,
+                 buckets=LATENCY_BUCKETS):
+        buckets = sorted(float(b) for b in buckets)
+        if not buckets or buckets[-1] != math.inf:
+            buckets.append(math.inf)
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.default().observe(value)
+
+    def time(self):
+        return self.default().time()
+
+    def samples(self):
+        with self.lock:
+            children = list(self.children.items())
+        for values, child in children:
+            with child.lock:
+                counts = list(child.counts)
+                total, count = child.sum, child.count
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield (self.name + "_bucket",
+                       format_labels(self.labelnames, values,
+                                     [("le", format_value(bound))]),
+                       cumulative)
+            labels = format_labels(self.labelnames, values)
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, count
+
+
+class Registry:
+    """
+    Set of metrics rendered together in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            if any(m.name == metric.name for m in self.metrics):
+                raise ValueError("Metric {} already registered".format(metric.name))
+            self.metrics.append(metric)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# content type of the Prometheus text format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
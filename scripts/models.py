@@ -1,31 +1,160 @@
+import os
+import hashlib
+import numpy as np
 import tensorflow as tf
 from tensorflow.keras.applications.resnet50 import ResNet50
 from tensorflow.keras.applications.resnet import ResNet152
 from tensorflow.keras.applications import VGG16, VGG19
 from tensorflow.keras import optimizers
 from keras.models import Model
-from keras.layers import Flatten, Dense
+from keras.layers import Flatten, Dense, Input, Conv1D, MaxPooling1D, \
+    GlobalAveragePooling1D, BatchNormalization, Dropout, Rescaling, Concatenate
 from keras.callbacks import ModelCheckpoint, EarlyStopping, TensorBoard
 
 img_width, img_height = 224, 224
 tf.compat.v1.disable_eager_execution()
 
+# backbone outputs of frozen models are cached here
+FEATURE_CACHE_DIR = '../bottleneck_cache'
+
+
+def scaled_image_input(channels=3):
+    """
+    Image input taking 0-255 pixel values (the dataset is kept as uint8)
+    and scaling them to [0, 1] in the graph, batch by batch. Gray images
+    (channels=1) are replicated to the 3 channels ImageNet backbones expect
+    in the graph as well.
+    """
+    inputs = Input(shape=(img_width, img_height, channels))
+    x = Rescaling(1. / 255)(inputs)
+    if channels == 1:
+        x = Concatenate(axis=-1)([x, x, x])
+    return x
+
+
+def is_dataset(data):
+    return isinstance(data, tf.data.Dataset)
+
+
+def input_shape_of(data):
+    """
+    Shape of a single input, from an array or a tf.data dataset of batches.
+    """
+    if is_dataset(data):
+        return tuple(tf.compat.v1.data.get_output_shapes(data)[0][1:])
+    return data.shape[1:]
+
+
+def fit_model(model_final, train_data, train_labels, test_data, test_labels,
+              batch_size, epochs, callbacks):
+    """
+    Fit a model on arrays, or on tf.data datasets yielding batches of
+    (inputs, labels) (see data_pipeline), in which case the labels
+    arguments are not used.
+    """
+    if is_dataset(train_data):
+        return model_final.fit(train_data, epochs=epochs, validation_data=test_data,
+                               callbacks=callbacks)
+    return model_final.fit(train_data, train_labels, batch_size=batch_size,
+                           epochs=epochs, shuffle=True, validation_data=(test_data, test_labels),
+                           callbacks=callbacks)
+
+
+def dataset_fingerprint(data):
+    """
+    Hash of the shape, type and content of a dataset array.
+    """
+    data = np.ascontiguousarray(data)
+    digest = hashlib.sha1()
+    digest.update(str((data.shape, data.dtype.str)).encode())
+    digest.update(memoryview(data).cast('B'))
+    return digest.hexdigest()
+
+
+def cached_features(backbone, backbone_name, data, batch_size):
+    """
+    Run a frozen backbone over a dataset once and cache its output on disk,
+    keyed by backbone and dataset fingerprint.
+    """
+    os.makedirs(FEATURE_CACHE_DIR, exist_ok=True)
+    cache_path = os.path.join(FEATURE_CACHE_DIR, "{}_{}.npy".format(
+        backbone_name, dataset_fingerprint(data)))
+
+    if os.path.exists(cache_path):
+        print("Using cached {} features {}".format(backbone_name, cache_path))
+        return np.load(cache_path, mmap_mode='r')
+
+    features = backbone.predict(data, batch_size=batch_size)
+    np.save(cache_path + '.tmp.npy', features)
+    os.replace(cache_path + '.tmp.npy', cache_path)
+    return features
+
+
+def fit_head_on_cached_features(backbone, backbone_name, train_data, train_labels,
+                                test_data, test_labels, batch_size, epochs,
+                                num_classes, output_file, log_dir, patience):
+    """
+    Train the Flatten+Dense head of a frozen backbone on cached backbone
+    features, so the backbone runs once instead of once per epoch. Returns
+    the backbone with the trained head on top (same model as the uncached
+    path).
+    """
+    if is_dataset(train_data):
+        raise Exception("Cached features need the dataset as arrays, not tf.data")
+
+    train_features = cached_features(
+        backbone, backbone_name, train_data, batch_size)
+    test_features = cached_features(
+        backbone, backbone_name, test_data, batch_size)
+
+    inputs = Input(shape=train_features.shape[1:])
+    x = Flatten()(inputs)
+    predictions = Dense(num_classes, activation="softmax")(x)
+    head = Model(inputs=inputs, outputs=predictions)
+
+    head.compile(loss="categorical_crossentropy", optimizer=optimizers.SGD(
+        lr=0.0001, momentum=0.9), metrics=["accuracy"])
+
+    # the best epoch's head is kept, like the checkpoint of the uncached path
+    early = EarlyStopping(monitor='val_accuracy', min_delta=0, patience=patience,
+                          verbose=1, mode='auto', restore_best_weights=True)
+    tbCallBack = TensorBoard(
+        log_dir=log_dir, histogram_freq=0, write_graph=True, write_images=True)
+
+    head.fit(train_features, train_labels, batch_size=batch_size,
+             epochs=epochs, shuffle=True, validation_data=(test_features, test_labels),
+             callbacks=[early, tbCallBack])
+
+    # creating the final model
+    model_final = Model(inputs=backbone.input, outputs=head(backbone.output))
+    model_final.compile(loss="categorical_crossentropy", optimizer=optimizers.SGD(
+        lr=0.0001, momentum=0.9), metrics=["accuracy"])
+    model_final.save(output_file)
+
+    return model_final
+
 
 def resnet50(train_data, train_labels, test_data, test_labels, batch_size, epochs,
-             num_classes, output_file):
+             num_classes, output_file, cache_features=False):
     """
     Train and test ResNet50 model.
 
     Parameters:
+        cache_features (bool): train head on cached backbone features
     """
 
     model = ResNet50(include_top=False, weights='imagenet',
-                     input_shape=(img_width, img_height, 3))
+                     input_tensor=scaled_image_input(input_shape_of(train_data)[-1]))
 
     # Freeze the layers which you don't want to train. Here I am freezing the all layers.
     for layer in model.layers[:]:
         layer.trainable = False
 
+    if cache_features:
+        return fit_head_on_cached_features(
+            model, "resnet50", train_data, train_labels, test_data, test_labels,
+            batch_size, epochs, num_classes, output_file, '../graph', 10)
+
     # Adding custom Layer
     # We only add
     x = model.output
@@ -40,35 +169,41 @@ def resnet50(train_data, train_labels, test_data, test_labels, batch_size, epoch
         lr=0.0001, momentum=0.9), metrics=["accuracy"])
 
     # Save the model according to the conditions
-    checkpoint = ModelCheckpoint(output_file, monitor='val_acc', verbose=1,
-                                 save_best_only=True, save_weights_only=False, mode='auto', period=1)
-    early = EarlyStopping(monitor='val_acc', min_delta=0,
-                          patience=10, verbose=1, mode='auto')
+    checkpoint = ModelCheckpoint(output_file, monitor='val_accuracy', verbose=1,
+                                 save_best_only=True, save_weights_only=False, mode='auto',
+                                 save_freq='epoch')
+    early = EarlyStopping(monitor='val_accuracy', min_delta=0,
+                          patience=10, verbose=1, mode='auto', restore_best_weights=True)
     tbCallBack = TensorBoard(
         log_dir='../graph', histogram_freq=0, write_graph=True, write_images=True)
 
-    model_final.fit(train_data, train_labels, batch_size=batch_size,
-                    epochs=epochs, shuffle=True, validation_data=(test_data, test_labels),
-                    callbacks=[checkpoint, early, tbCallBack])
+    fit_model(model_final, train_data, train_labels, test_data, test_labels,
+              batch_size, epochs, [checkpoint, early, tbCallBack])
 
     return model_final
 
 
 def resnet152(train_data, train_labels, test_data, test_labels, batch_size, epochs,
-              num_classes, output_file):
+              num_classes, output_file, cache_features=False):
     """
     Train and test ResNet50 model.
 
     Parameters:
+        cache_features (bool): train head on cached backbone features
     """
 
     model = ResNet152(include_top=False, weights='imagenet',
-                      input_shape=(img_width, img_height, 3))
+                      input_tensor=scaled_image_input(input_shape_of(train_data)[-1]))
 
     # Freeze the layers which you don't want to train. Here I am freezing the all layers.
     for layer in model.layers[:]:
         layer.trainable = False
 
+    if cache_features:
+        return fit_head_on_cached_features(
+            model, "resnet152", train_data, train_labels, test_data, test_labels,
+            batch_size, epochs, num_classes, output_file, '../graph/resnet152', 5)
+
     x = model.output
     x = Flatten()(x)
     predictions = Dense(num_classes, activation="softmax")(x)
@@ -81,36 +216,42 @@ def resnet152(train_data, train_labels, test_data, test_labels, batch_size, epoc
         lr=0.0001, momentum=0.9), metrics=["accuracy"])
 
     # Save the model according to the conditions
-    checkpoint = ModelCheckpoint(output_file, monitor='val_acc', verbose=1,
-                                 save_best_only=True, save_weights_only=False, mode='auto', period=1)
-    early = EarlyStopping(monitor='val_acc', min_delta=0,
-                          patience=5, verbose=1, mode='auto')
+    checkpoint = ModelCheckpoint(output_file, monitor='val_accuracy', verbose=1,
+                                 save_best_only=True, save_weights_only=False, mode='auto',
+                                 save_freq='epoch')
+    early = EarlyStopping(monitor='val_accuracy', min_delta=0,
+                          patience=5, verbose=1, mode='auto', restore_best_weights=True)
 
     tbCallBack = TensorBoard(
         log_dir='../graph/resnet152', histogram_freq=0, write_graph=True, write_images=True)
 
-    model_final.fit(train_data, train_labels, batch_size=batch_size,
-                    epochs=epochs, shuffle=True, validation_data=(test_data, test_labels),
-                    callbacks=[checkpoint, early, tbCallBack])
+    fit_model(model_final, train_data, train_labels, test_data, test_labels,
+              batch_size, epochs, [checkpoint, early, tbCallBack])
 
     return model_final
 
 
 def vgg16(train_data, train_labels, test_data, test_labels, batch_size, epochs,
-          num_classes, output_file):
+          num_classes, output_file, cache_features=False):
     """
     Train and test ResNet50 model.
 
     Parameters:
+        cache_features (bool): train head on cached backbone features
     """
 
     model = VGG16(include_top=False, weights='imagenet',
-                  input_shape=(img_width, img_height, 3))
+                  input_tensor=scaled_image_input(input_shape_of(train_data)[-1]))
 
     # Freeze the layers which you don't want to train. Here I am freezing the all layers.
     for layer in model.layers[:]:
         layer.trainable = False
 
+    if cache_features:
+        return fit_head_on_cached_features(
+            model, "vgg16", train_data, train_labels, test_data, test_labels,
+            batch_size, epochs, num_classes, output_file, '../graph/vgg16', 5)
+
     x = model.output
     x = Flatten()(x)
     predictions = Dense(num_classes, activation="softmax")(x)
@@ -123,36 +264,42 @@ def vgg16(train_data, train_labels, test_data, test_labels, batch_size, epochs,
         lr=0.0001, momentum=0.9), metrics=["accuracy"])
 
     # Save the model according to the conditions
-    checkpoint = ModelCheckpoint(output_file, monitor='val_acc', verbose=1,
-                                 save_best_only=True, save_weights_only=False, mode='auto', period=1)
-    early = EarlyStopping(monitor='val_acc', min_delta=0,
-                          patience=5, verbose=1, mode='auto')
+    checkpoint = ModelCheckpoint(output_file, monitor='val_accuracy', verbose=1,
+                                 save_best_only=True, save_weights_only=False, mode='auto',
+                                 save_freq='epoch')
+    early = EarlyStopping(monitor='val_accuracy', min_delta=0,
+                          patience=5, verbose=1, mode='auto', restore_best_weights=True)
 
     tbCallBack = TensorBoard(
         log_dir='../graph/vgg16', histogram_freq=0, write_graph=True, write_images=True)
 
-    model_final.fit(train_data, train_labels, batch_size=batch_size,
-                    epochs=epochs, shuffle=True, validation_data=(test_data, test_labels),
-                    callbacks=[checkpoint, early, tbCallBack])
+    fit_model(model_final, train_data, train_labels, test_data, test_labels,
+              batch_size, epochs, [checkpoint, early, tbCallBack])
 
     return model_final
 
 
 def vgg19(train_data, train_labels, test_data, test_labels, batch_size, epochs,
-          num_classes, output_file):
+          num_classes, output_file, cache_features=False):
     """
     Train and test ResNet50 model.
 
     Parameters:
+        cache_features (bool): train head on cached backbone features
     """
 
     model = VGG19(include_top=False, weights='imagenet',
-                  input_shape=(img_width, img_height, 3))
+                  input_tensor=scaled_image_input(input_shape_of(train_data)[-1]))
 
     # Freeze the layers which you don't want to train. Here I am freezing the all layers.
     for layer in model.layers[:]:
         layer.trainable = False
 
+    if cache_features:
+        return fit_head_on_cached_features(
+            model, "vgg19", train_data, train_labels, test_data, test_labels,
+            batch_size, epochs, num_classes, output_file, '../graph/vgg19', 5)
+
     x = model.output
     x = Flatten()(x)
     predictions = Dense(num_classes, activation="softmax")(x)
@@ -165,16 +312,84 @@ def vgg19(train_data, train_labels, test_data, test_labels, batch_size, epochs,
         lr=0.0001, momentum=0.9), metrics=["accuracy"])
 
     # Save the model according to the conditions
-    checkpoint = ModelCheckpoint(output_file, monitor='val_acc', verbose=1,
-                                 save_best_only=True, save_weights_only=False, mode='auto', period=1)
-    early = EarlyStopping(monitor='val_acc', min_delta=0,
-                          patience=5, verbose=1, mode='auto')
+    checkpoint = ModelCheckpoint(output_file, monitor='val_accuracy', verbose=1,
+                                 save_best_only=True, save_weights_only=False, mode='auto',
+                                 save_freq='epoch')
+    early = EarlyStopping(monitor='val_accuracy', min_delta=0,
+                          patience=5, verbose=1, mode='auto', restore_best_weights=True)
 
     tbCallBack = TensorBoard(
         log_dir='../graph/vgg19', histogram_freq=0, write_graph=True, write_images=True)
 
-    model_final.fit(train_data, train_labels, batch_size=batch_size,
-                    epochs=epochs, shuffle=True, validation_data=(test_data, test_labels),
-                    callbacks=[checkpoint, early, tbCallBack])
+    fit_model(model_final, train_data, train_labels, test_data, test_labels,
+              batch_size, epochs, [checkpoint, early, tbCallBack])
+
+    return model_final
+
+
+def cnn1d(train_data, train_labels, test_data, test_labels, batch_size, epochs,
+          num_classes, output_file):
+    """
+    Train and test 1D CNN model on raw beat windows (no image rendering).
+
+    Parameters:
+    """
+
+    inputs = Input(shape=input_shape_of(train_data))
+
+    x = Conv1D(32, 7, padding='same', activation='relu')(inputs)
+    x = BatchNormalization()(x)
+    x = MaxPooling1D(2)(x)
+
+    x = Conv1D(64, 5, padding='same', activation='relu')(x)
+    x = BatchNormalization()(x)
+    x = MaxPooling1D(2)(x)
+
+    x = Conv1D(128, 3, padding='same', activation='relu')(x)
+    x = BatchNormalization()(x)
+    x = MaxPooling1D(2)(x)
+
+    x = Conv1D(128, 3, padding='same', activation='relu')(x)
+    x = GlobalAveragePooling1D()(x)
+    x = Dense(64, activation='relu')(x)
+    x = Dropout(0.3)(x)
+    predictions = Dense(num_classes, activation="softmax")(x)
+
+    # creating the final model
+    model_final = Model(inputs=inputs, outputs=predictions)
+
+    # compile the model (trained from scratch, so a faster optimizer than the
+    # frozen backbones)
+    model_final.compile(loss="categorical_crossentropy", optimizer=optimizers.Adam(
+        learning_rate=0.001), metrics=["accuracy"])
+
+    # Save the model according to the conditions
+    checkpoint = ModelCheckpoint(output_file, monitor='val_accuracy', verbose=1,
+                                 save_best_only=True, save_weights_only=False, mode='auto',
+                                 save_freq='epoch')
+    early = EarlyStopping(monitor='val_accuracy', min_delta=0,
+                          patience=5, verbose=1, mode='auto', restore_best_weights=True)
+
+    tbCallBack = TensorBoard(
+        log_dir='../graph/cnn1d', histogram_freq=0, write_graph=True, write_images=True)
+
+    fit_model(model_final, train_data, train_labels, test_data, test_labels,
+              batch_size, epochs, [checkpoint, early, tbCallBack])
 
     return model_final
+
+
+# models that can be trained by name
+MODEL_TRAINERS = {
+    "resnet50": resnet50,
+    "resnet152": resnet152,
+    "vgg16": vgg16,
+    "vgg19": vgg19,
+    "cnn1d": cnn1d,
+}
+
+# models whose backbone is frozen (support cache_features)
+FROZEN_BACKBONE_MODELS = ["resnet50", "resnet152", "vgg16", "vgg19"]
+
+# models trained on signal windows instead of beat images
+SIGNAL_MODELS = ["cnn1d"]
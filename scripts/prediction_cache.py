@@ -0,0 +1,135 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+def file_version(path, block_size=1 << 20):
+    """
+    Short sha256 of a model file, used as model version so cached
+    predictions of another model are never returned.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+class PredictionCache:
+    """
+    Cache of model outputs keyed by the content of the decoded input.
+
+    The key is the sha256 of the model version, the dtype and shape of the
+    input and its bytes, so the same beat sent as a path, an upload or a
+    signal hits the same entry once decoded. The newest max_entries
+    outputs are kept in memory and the least recently used is evicted.
+    If disk_dir is given outputs are also written there, one .npy per key,
+    so they survive restarts and can be shared by several processes.
+    """
+
+    def __init__(self, max_entries=10000, model_version="", disk_dir=None):
+        self.max_entries = max_entries
+        self.model_version = model_version
+        self.disk_dir = disk_dir
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def key(self, x):
+        x = np.ascontiguousarray(x)
+        digest = hashlib.sha256()
+        digest.update(self.model_version.encode())
+        digest.update(str(x.dtype).encode())
+        digest.update(str(x.shape).encode())
+        digest.update(x.data)
+        return digest.hexdigest()
+
+    def disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + ".npy")
+
+    def remember(self, key, value):
+        # add to memory tier, evicting least recently used entries
+        # copied, a row of a batch would keep the whole batch alive
+        value = np.array(value)
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def lookup(self, x):
+        """
+        Find the cached output of an input.
+
+        Returns:
+            key (str): key of input, pass it to store() on a miss
+
+            value (numpy array): cached output, None on a miss
+
+            source (str): "memory", "disk" or None on a miss
+        """
+        key = self.key(x)
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return key, value, "memory"
+
+        if self.disk_dir is not None:
+            try:
+                value = np.load(self.disk_path(key), allow_pickle=False)
+            except (OSError, ValueError):
+                value = None
+            if value is not None:
+                self.remember(key, value)
+                with self.lock:
+                    self.disk_hits += 1
+                return key, value, "disk"
+
+        with self.lock:
+            self.misses += 1
+        return key, None, None
+
+    def save(self, key, value):
+        """
+        Write an output to the disk tier (nothing without disk_dir).
+        """
+        if self.disk_dir is None:
+            return
+        path = self.disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written under a unique name and renamed, readers in other
+        # processes never see a partial file
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_path, "wb") as f:
+                np.save(f, np.asarray(value), allow_pickle=False)
+            os.replace(tmp_path, path)
+        except OSError:
+            # disk tier is best effort
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def store(self, key, value):
+        """
+        Cache the output computed for the input with this key.
+        """
+        self.remember(key, value)
+        self.save(key, value)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "max_entries": self.max_entries,
+                    "hits": self.hits, "disk_hits": self.disk_hits,
+                    "misses": self.misses}
@@ -0,0 +1,203 @@
+# This file times the stages of beat extraction. Each process keeps, for
+# every stage, the number of calls, total time and a histogram of call
+# times in power of two buckets of microseconds. Worker processes hand
+# their stats to the main process, which merges them into one report.
+# Timing is off unless enabled (PROFILE_EXTRACTION=1 or enable()), and a
+# disabled stage costs one flag check.
+
+import os
+import time
+
+ENV_VARIABLE = 'PROFILE_EXTRACTION'
+
+# call times above 2 ** (NUM_BUCKETS - 1) microseconds go in the last bucket
+NUM_BUCKETS = 40
+
+enabled = os.environ.get(ENV_VARIABLE) == '1'
+
+# stage name -> [calls, total seconds, max seconds, histogram]
+stats = {}
+# counter name -> count
+counters = {}
+
+
+def enable():
+    '''
+    turn timing on in this process and in worker processes started after
+    this call
+    '''
+    global enabled
+    enabled = True
+    os.environ[ENV_VARIABLE] = '1'
+
+
+def record(name, seconds):
+    '''
+    add one call of a stage
+
+    Args:
+            name (str): name of stage
+
+            seconds (float): time taken by call
+    '''
+    entry = stats.get(name)
+    if entry is None:
+        entry = stats[name] = [0, 0.0, 0.0, [0] * NUM_BUCKETS]
+    entry[0] += 1
+    entry[1] += seconds
+    if seconds > entry[2]:
+        entry[2] = seconds
+    bucket = min(int(seconds * 1e6).bit_length(), NUM_BUCKETS - 1)
+    entry[3][bucket] += 1
+
+
+def count(name, n=1):
+    '''
+    add n to a counter
+    '''
+    if enabled:
+        counters[name] = counters.get(name, 0) + n
+
+
+class StageTimer:
+    """
+    Context manager timing the code in its block as one call of a stage.
+    """
+
+    __slots__ = ['name', 'start']
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class NullTimer:
+    """
+    Context manager doing nothing, used when timing is off.
+    """
+
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+def stage(name):
+    '''
+    time a block of code as one call of a stage:
+
+        with profiling.stage('rdsamp'):
+            ...
+
+    Args:
+            name (str): name of stage
+
+    Returns:
+            (context manager): timer, or a shared no-op when timing is off
+    '''
+    if enabled:
+        return StageTimer(name)
+    return NULL_TIMER
+
+
+def reset():
+    '''
+    drop the stats gathered in this process, used as initializer of worker
+    processes so forked workers do not report the stats of their parent
+    '''
+    takeSnapshot()
+
+
+def takeSnapshot():
+    '''
+    take the stats gathered in this process since the last snapshot, so a
+    worker can send them to the main process with each result
+
+    Returns:
+            (dict): stages and counters (plain python objects)
+    '''
+    global stats, counters
+    snapshot = {'stages': stats, 'counters': counters}
+    stats = {}
+    counters = {}
+    return snapshot
+
+
+def mergeSnapshot(total, snapshot):
+    '''
+    add a snapshot to a total (a snapshot as well)
+
+    Args:
+            total (dict): merged stats, updated in place
+
+            snapshot (dict): stats taken with takeSnapshot
+    '''
+    total.setdefault('stages', {})
+    total.setdefault('counters', {})
+    for name, (calls, seconds, max_seconds, histogram) in snapshot['stages'].items():
+        entry = total['stages'].get(name)
+        if entry is None:
+            total['stages'][name] = [calls, seconds, max_seconds, list(histogram)]
+            continue
+        entry[0] += calls
+        entry[1] += seconds
+        entry[2] = max(entry[2], max_seconds)
+        entry[3] = [a + b for a, b in zip(entry[3], histogram)]
+    for name, n in snapshot['counters'].items():
+        total['counters'][name] = total['counters'].get(name, 0) + n
+
+
+def histogramPercentile(histogram, q):
+    # upper bound (seconds) of the bucket holding the q-th percentile call
+    calls = sum(histogram)
+    if calls == 0:
+        return 0.0
+    seen = 0
+    for bucket, n in enumerate(histogram):
+        seen += n
+        if seen >= q / 100 * calls:
+            return (2 ** bucket) / 1e6
+    return (2 ** (len(histogram) - 1)) / 1e6
+
+
+def formatReport(snapshot, wall_seconds=None):
+    '''
+    format merged stats as a table, stages sorted by total time
+
+    Args:
+            snapshot (dict): merged stats
+
+            wall_seconds (float): wall clock time of the run (optional)
+
+    Returns:
+            (str): report
+    '''
+    stages = snapshot.get('stages', {})
+    busy = sum(entry[1] for entry in stages.values())
+    lines = ['{:<24}{:>10}{:>12}{:>8}{:>12}{:>12}{:>12}'.format(
+        'stage', 'calls', 'total s', '%', 'mean ms', 'p99 ms', 'max ms')]
+    for name, (calls, seconds, max_seconds, histogram) in sorted(
+            stages.items(), key=lambda item: -item[1][1]):
+        lines.append('{:<24}{:>10}{:>12.2f}{:>8.1f}{:>12.3f}{:>12.3f}{:>12.3f}'.format(
+            name, calls, seconds, 100 * seconds / busy if busy > 0 else 0.0,
+            1e3 * seconds / calls,
+            1e3 * min(histogramPercentile(histogram, 99), max_seconds),
+            1e3 * max_seconds))
+    for name, n in sorted(snapshot.get('counters', {}).items()):
+        lines.append('{:<24}{:>10}'.format(name, n))
+    if wall_seconds is not None:
+        lines.append('wall clock {:.2f}s'.format(wall_seconds))
+    return '\n'.join(lines)
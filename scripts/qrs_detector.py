@@ -0,0 +1,327 @@
+# This file has an incremental QRS detector for signals that arrive in
+# chunks (Pan-Tompkins: band pass, derivative, squaring, moving window
+# integration and adaptive thresholds). Filter and threshold state is
+# carried between chunks and only a short history of the signal is kept,
+# so memory does not grow with the length of the recording. Running the
+# file compares it with the batch detectors of signal_api on the MIT-BIH
+# records.
+
+import argparse
+from collections import deque
+import numpy as np
+from scipy import signal as sp_signal
+
+# pass band of QRS filter (Hz)
+BANDPASS_LOW = 5
+BANDPASS_HIGH = 15
+# width of moving window integration (s)
+INTEGRATION_SECONDS = 0.15
+# signal used to learn initial thresholds (s)
+LEARNING_SECONDS = 2
+# no second QRS within this time of a QRS (s)
+REFRACTORY_SECONDS = 0.2
+# QRS this close to the previous one may be a T wave (s)
+T_WAVE_SECONDS = 0.36
+# missed QRS is searched for after this many average RR intervals
+SEARCH_BACK_RR = 1.66
+# number of RR intervals averaged
+RR_AVERAGE_BEATS = 8
+# history of signal kept for locating R peaks (s)
+HISTORY_SECONDS = 1
+# R peak is refined within this distance in the raw signal (s)
+REFINE_SECONDS = 0.05
+
+
+class StreamingQRSDetector:
+    """
+    Detect QRS complexes in a signal that is passed in chunks of any size.
+
+    Call process() with every new chunk; it returns the sample positions
+    (counted from the first sample ever passed in) of the R peaks confirmed
+    by that chunk. A peak is confirmed when the integrated signal reaches
+    its maximum, i.e. a few hundred ms after the R peak, or later when it
+    is recovered by search back.
+    """
+
+    def __init__(self, fs):
+        self.fs = fs
+
+        # filters, their state is kept between chunks
+        self.bp_b, self.bp_a = sp_signal.butter(
+            1, [BANDPASS_LOW / (fs / 2), BANDPASS_HIGH / (fs / 2)], btype='bandpass')
+        w = 2 * np.pi * (BANDPASS_LOW + BANDPASS_HIGH) / 2 / fs
+        self.bp_delay = int(round(sp_signal.group_delay(
+            (self.bp_b, self.bp_a), w=[w])[1][0]))
+        self.deriv_b = np.array([2, 1, 0, -1, -2]) / 8
+        self.mwi_width = max(int(round(INTEGRATION_SECONDS * fs)), 1)
+        self.mwi_b = np.ones(self.mwi_width) / self.mwi_width
+        self.bp_zi = None
+        self.deriv_zi = np.zeros(len(self.deriv_b) - 1)
+        self.mwi_zi = np.zeros(self.mwi_width - 1)
+
+        # number of samples processed so far
+        self.n = 0
+        # short history of raw, band passed and derivative signal
+        self.history_size = max(int(HISTORY_SECONDS * fs), 4 * self.mwi_width)
+        # longer chunks are processed in blocks so peaks stay in history
+        self.block_size = self.history_size // 2
+        self.history_start = 0
+        self.history_x = np.zeros(0)
+        self.history_bp = np.zeros(0)
+        self.history_d = np.zeros(0)
+        # last two integrated samples, to find maxima across chunks
+        self.mwi_tail = np.zeros(0)
+
+        # learning of initial thresholds
+        self.learning = True
+        self.learning_max = 0.0
+        self.learning_sum = 0.0
+        self.learning_count = 0
+        self.learning_peaks = []
+
+        # adaptive thresholds
+        self.spki = 0.0
+        self.npki = 0.0
+        self.rr = deque(maxlen=RR_AVERAGE_BEATS)
+        self.last_qrs = None  # (integrated peak, r peak, slope)
+        self.noise_peaks = deque(maxlen=64)  # peaks since last qrs
+        self.last_r = -1
+
+        self.refractory = int(REFRACTORY_SECONDS * fs)
+        self.t_wave = int(T_WAVE_SECONDS * fs)
+        self.refine = int(REFINE_SECONDS * fs)
+
+    def _history(self, history, start, end):
+        start = max(start - self.history_start, 0)
+        end = max(end - self.history_start, 0)
+        return history[start:end]
+
+    def _locate(self, peak):
+        # r peak: largest band passed value in integration window, moved
+        # back by filter delay and refined in raw signal
+        window_start = peak - self.mwi_width - 2
+        bp = self._history(self.history_bp, window_start, peak + 1)
+        if len(bp) == 0:
+            return peak, 0.0
+        r = max(window_start, self.history_start) + int(np.argmax(np.abs(bp)))
+        r -= self.bp_delay
+
+        x = self._history(self.history_x, r - self.refine, r + self.refine + 1)
+        if len(x):
+            r = max(r - self.refine, self.history_start) + \
+                int(np.argmax(np.abs(x - np.median(x))))
+
+        d = self._history(self.history_d, window_start, peak + 1)
+        slope = float(np.max(np.abs(d))) if len(d) else 0.0
+        return r, slope
+
+    def _threshold(self):
+        return self.npki + 0.25 * (self.spki - self.npki)
+
+    def _accept(self, peak, value, r, slope, search_back=False):
+        if search_back:
+            self.spki = 0.25 * value + 0.75 * self.spki
+        else:
+            self.spki = 0.125 * value + 0.875 * self.spki
+        if self.last_qrs is not None:
+            self.rr.append(peak - self.last_qrs[0])
+        self.last_qrs = (peak, r, slope)
+        # keep noise peaks that came after the accepted one
+        self.noise_peaks = deque([p for p in self.noise_peaks if p[0] > peak],
+                                 maxlen=self.noise_peaks.maxlen)
+        if r > self.last_r:
+            self.last_r = r
+            return [r]
+        return []
+
+    def _search_back(self, position):
+        # recover a missed qrs from the noise peaks if none was found for
+        # too long
+        if self.last_qrs is None or len(self.rr) == 0:
+            return []
+        rr_average = np.mean(self.rr)
+        if position - self.last_qrs[0] <= SEARCH_BACK_RR * rr_average:
+            return []
+        threshold = 0.5 * self._threshold()
+        candidates = [p for p in self.noise_peaks
+                      if p[1] > threshold and p[0] - self.last_qrs[0] > self.refractory]
+        if not candidates:
+            return []
+        peak, value, r, slope = max(candidates, key=lambda p: p[1])
+        return self._accept(peak, value, r, slope, search_back=True)
+
+    def _classify(self, peak, value, r, slope):
+        found = self._search_back(peak)
+
+        if self.last_qrs is not None and peak - self.last_qrs[0] < self.refractory:
+            return found
+
+        if value > self._threshold():
+            # a peak soon after the last qrs with less than half its slope
+            # is a T wave
+            if self.last_qrs is not None and peak - self.last_qrs[0] < self.t_wave \
+                    and slope < 0.5 * self.last_qrs[2]:
+                self.npki = 0.125 * value + 0.875 * self.npki
+                self.noise_peaks.append((peak, value, r, slope))
+                return found
+            return found + self._accept(peak, value, r, slope)
+
+        self.npki = 0.125 * value + 0.875 * self.npki
+        self.noise_peaks.append((peak, value, r, slope))
+        return found
+
+    def process(self, samples):
+        """
+        Process the next chunk of the signal.
+
+        Args:
+            samples (list): next samples of signal
+
+        Returns:
+            (list): sample positions of newly confirmed R peaks
+        """
+        x = np.asarray(samples, dtype=np.float64).reshape(-1)
+        if len(x) == 0:
+            return []
+        if len(x) > self.block_size:
+            found = []
+            for start in range(0, len(x), self.block_size):
+                found += self.process(x[start:start + self.block_size])
+            return found
+
+        if self.bp_zi is None:
+            self.bp_zi = sp_signal.lfilter_zi(self.bp_b, self.bp_a) * x[0]
+        bp, self.bp_zi = sp_signal.lfilter(self.bp_b, self.bp_a, x, zi=self.bp_zi)
+        d, self.deriv_zi = sp_signal.lfilter(self.deriv_b, [1], bp, zi=self.deriv_zi)
+        mwi, self.mwi_zi = sp_signal.lfilter(self.mwi_b, [1], d * d, zi=self.mwi_zi)
+
+        # keep short history
+        self.history_x = np.concatenate([self.history_x, x])
+        self.history_bp = np.concatenate([self.history_bp, bp])
+        self.history_d = np.concatenate([self.history_d, d])
+        drop = len(self.history_x) - self.history_size
+        if drop > 0:
+            self.history_x = self.history_x[drop:]
+            self.history_bp = self.history_bp[drop:]
+            self.history_d = self.history_d[drop:]
+            self.history_start += drop
+
+        # local maxima of integrated signal
+        m = np.concatenate([self.mwi_tail, mwi])
+        m_start = self.n - len(self.mwi_tail)
+        i = np.flatnonzero((m[1:-1] > m[:-2]) & (m[1:-1] >= m[2:])) + 1
+        self.mwi_tail = m[-2:]
+        self.n += len(x)
+
+        found = []
+        for peak, value in zip(m_start + i, m[i]):
+            r, slope = self._locate(int(peak))
+            candidate = (int(peak), float(value), r, slope)
+
+            if self.learning:
+                self.learning_peaks.append(candidate)
+                continue
+            found += self._classify(*candidate)
+
+        if self.learning:
+            self.learning_max = max(self.learning_max, float(mwi.max()))
+            self.learning_sum += float(mwi.sum())
+            self.learning_count += len(mwi)
+            if self.n >= LEARNING_SECONDS * self.fs:
+                found += self._end_learning()
+        else:
+            found += self._search_back(self.n)
+
+        return found
+
+    def _end_learning(self):
+        # initial thresholds from learning signal, then classify the peaks
+        # that were held back while learning
+        self.learning = False
+        self.spki = 0.25 * self.learning_max
+        self.npki = 0.5 * self.learning_sum / max(self.learning_count, 1)
+        found = []
+        for candidate in self.learning_peaks:
+            found += self._classify(*candidate)
+        self.learning_peaks = []
+        return found
+
+
+def detectInChunks(signal, fs, chunk_size):
+    '''
+    run streaming detector over a whole signal passed in chunks
+
+    Args:
+            signal (numpy array): samples of signal
+
+            fs (int): frequency of signal
+
+            chunk_size (int): number of samples passed at once
+
+    Returns:
+            (numpy array): R peak locations
+    '''
+    detector = StreamingQRSDetector(fs)
+    found = []
+    for start in range(0, len(signal), chunk_size):
+        found += detector.process(signal[start:start + chunk_size])
+    return np.array(found, dtype=np.int64)
+
+
+def compareWithBatchDetectors(file_path, chunk_size):
+    '''
+    compare streaming detector with XQRS, GQRS and the record annotations
+
+    Args:
+            file_path (str): path of record (without extension)
+
+            chunk_size (int): number of samples passed at once
+
+    Returns:
+            (dict): sensitivity and positive predictivity of streaming
+            detector against each reference
+    '''
+    import wfdb
+    from wfdb import processing
+    import signal_api
+
+    signal, fields = signal_api.getRecordSignal(file_path)
+    fs = fields['fs']
+    window = int(0.15 * fs)
+
+    streamed = detectInChunks(signal[:, 0], fs, chunk_size)
+    ann = wfdb.rdann(file_path, 'atr')
+    references = {
+        'xqrs': np.asarray(signal_api.getXQRS(signal, fields).qrs_inds),
+        'gqrs': np.asarray(signal_api.getQRSLocations(file_path)),
+        'annotations': np.asarray(ann.sample),
+    }
+
+    result = {'record': file_path, 'beats': len(streamed)}
+    for name, reference in references.items():
+        comparitor = processing.compare_annotations(reference, streamed, window)
+        result[name] = {'sensitivity': comparitor.sensitivity,
+                        'positive_predictivity': comparitor.positive_predictivity}
+    return result
+
+
+if __name__ == '__main__':
+    import json
+    import directory_structure
+
+    args = argparse.ArgumentParser()
+    args.add_argument('--records', type=str, nargs='*', default=None,
+                      help='record names to check (default all)')
+    args.add_argument('--chunk-size', type=int, default=360,
+                      help='number of samples passed to detector at once')
+    args = args.parse_args()
+
+    signal_dir = directory_structure.getReadDirectory('mit-bih_waveform')
+    records = args.records
+    if not records:
+        records = sorted(directory_structure.removeFileExtension(f) for f in
+                         directory_structure.filesInDirectory('.hea', signal_dir))
+
+    for record in records:
+        print(json.dumps(compareWithBatchDetectors(
+            signal_dir + record, args.chunk_size)))
@@ -2,18 +2,27 @@
 # reading signal information from mit-bih dataset and plotting hearbeats.
 
 import pandas as pd
+import numpy as np
 import os
 import wfdb
 from wfdb import processing  # not importing processing
 import matplotlib.pyplot as plt
 from PIL import Image
 import directory_structure
+import beat_renderer
+import beat_shards
+import profiling
 import re
+from beat_window import BEAT_START_OFFSET, BEAT_END_OFFSET, sliceSignal
 
 # number of heartbeats to extract
 NUM_HEARTBEATS_TO_EXTRACT = 1
-BEAT_START_OFFSET = 100
-BEAT_END_OFFSET = 100
+
+# draw beats with numpy renderer instead of plotting them with matplotlib
+USE_BEAT_RENDERER = True
+
+# number of samples each beat is resampled to when stored as a signal window
+WINDOW_LENGTH = 256
 
 
 def takeAllInputs():
@@ -74,12 +83,32 @@ def getSignalInfo(file_path, sample_from, sample_to):
     elif sample_from < 0:
         sample_from = 0
 
-    signal, fields = wfdb.rdsamp(
-        file_path, sampfrom=sample_from, sampto=sample_to, channels=[0])
+    with profiling.stage('rdsamp'):
+        signal, fields = wfdb.rdsamp(
+            file_path, sampfrom=sample_from, sampto=sample_to, channels=[0])
+    return signal, fields
+
+
+def getRecordSignal(file_path):
+    '''
+    Reads the whole signal of a record once so that beats can be sliced
+    out of it in memory instead of re-reading the record for every beat
+
+    Args:
+            file_path (str): the location of record to read
+
+    Returns:
+            signal (numpy array): samples of first channel of the record
+
+            fields (dict): properties of signal
+    '''
+    with profiling.stage('rdsamp_record'):
+        signal, fields = wfdb.rdsamp(file_path, channels=[0])
     return signal, fields
 
 
-def writeSingleBeat(file_path, beat_start, beat_end, beat_number, beat_type):
+def writeSingleBeat(file_path, beat_start, beat_end, beat_number, beat_type,
+                    record_signal=None):
     '''
     Plots the single beat of a signal
 
@@ -93,18 +122,31 @@ def writeSingleBeat(file_path, beat_start, beat_end, beat_number, beat_type):
                     beat_number (int): the index of what beat is currently being plotted
 
                     beat_type (str): classification label of beat
+
+                    record_signal (numpy array): signal of whole record, if it has
+                    already been read (optional)
     '''
 
     # save directory where beats need to be written
-    beat_wr_dir = directory_structure.getWriteDirectory(
-        'beat_write_dir', beat_type)
+    with profiling.stage('get_write_directory'):
+        beat_wr_dir = directory_structure.getWriteDirectory(
+            'beat_write_dir', beat_type)
     print("Beat type: ", beat_type)
 
-    # get signal and fields of specified file_path
-    signal, fields = getSignalInfo(file_path, beat_start, beat_end)
+    # get signal of beat, reading it from file_path only if record is not loaded
+    if record_signal is None:
+        signal, fields = getSignalInfo(file_path, beat_start, beat_end)
+    else:
+        signal = sliceSignal(record_signal, beat_start, beat_end)
 
     # plot beat
-    saveSignal(signal, beat_number, beat_wr_dir, file_path)
+    if USE_BEAT_RENDERER:
+        with profiling.stage('render_beat'):
+            image = beat_renderer.renderBeat(signal)
+        saveBeatImage(image, beat_number, beat_wr_dir, file_path)
+    else:
+        saveSignal(signal, beat_number, beat_wr_dir, file_path)
+    profiling.count('beats')
 
 
 def saveSignal(signal, beat_number, wr_dir, file_path):
@@ -123,20 +165,44 @@ def saveSignal(signal, beat_number, wr_dir, file_path):
     file_number = (getNumbersFromString(file_path))[0]
 
     # plot color signal and save
-    plt.plot(signal)
-    plt.axis('off')
-    plt.savefig(wr_dir + '/image_' + file_number +
-                '_' + str(beat_number), dpi=125)
+    with profiling.stage('plot'):
+        plt.plot(signal)
+        plt.axis('off')
+    with profiling.stage('savefig'):
+        plt.savefig(wr_dir + '/image_' + file_number +
+                    '_' + str(beat_number), dpi=125)
 
     # convert grayscale and overwrite
-    img = Image.open(wr_dir + '/image_' + file_number + '_' +
-                     str(beat_number) + '.png').convert('LA')
-    img = img.resize((224, 224))
-    img.save(wr_dir + '/image_' + file_number +
-             '_' + str(beat_number) + '.png')
+    with profiling.stage('pil_convert_resize_save'):
+        img = Image.open(wr_dir + '/image_' + file_number + '_' +
+                         str(beat_number) + '.png').convert('LA')
+        img = img.resize((224, 224))
+        img.save(wr_dir + '/image_' + file_number +
+                 '_' + str(beat_number) + '.png')
 
     # clear plot before next plot
-    plt.clf()
+    with profiling.stage('clear_plot'):
+        plt.clf()
+
+
+def saveBeatImage(image, beat_number, wr_dir, file_path):
+    '''
+    Saves an image drawn by beat_renderer under the same name saveSignal uses
+
+    Args:	
+                    image (numpy array): grayscale uint8 image of beat
+
+                    beat_number (int): the index of what beat is currently being plotted
+
+                    wr_dir (str): directory to where beat needs to be written
+
+                    file_path (str): the location of file to plot
+    '''
+    file_number = (getNumbersFromString(file_path))[0]
+
+    with profiling.stage('save_png'):
+        Image.fromarray(image, 'L').save(wr_dir + '/image_' + file_number +
+                                         '_' + str(beat_number) + '.png')
 
 
 def getNumbersFromString(string):
@@ -204,7 +270,30 @@ def getQRSLocations(file_path):
     return qrs_locs
 
 
-def extractBeatsFromPatient(file_path, ann):
+def getBeatRange(ann, first_beat=0, last_beat=None):
+    '''
+    clamp a range of beats to the beats of a record (a beat ends at the next
+    annotation, so a record with n annotations has n - 1 beats)
+
+    Args:
+            ann (annotation): annotation information of file
+
+            first_beat (int): first beat of range
+
+            last_beat (int): beat after last beat of range (None for all
+            remaining beats)
+
+    Returns:
+            (range): beat numbers in range
+    '''
+    num_beats = max(len(ann.sample) - 1, 0)
+    if last_beat is None or last_beat > num_beats:
+        last_beat = num_beats
+    return range(max(first_beat, 0), last_beat)
+
+
+def extractBeatsFromPatient(file_path, ann, first_beat=0, last_beat=None,
+                            record_signal=None):
     '''
     finds qrs complexes in specified patient file and save the resulting
     signals in the form of png images in the image write directory (beat_wr_dir)
@@ -213,22 +302,162 @@ def extractBeatsFromPatient(file_path, ann):
             file_path (str): path of where patient data is present
 
             ann_df (dataframe): data frame containing annotation information of file
+
+            first_beat (int): first beat to save
+
+            last_beat (int): beat after last beat to save (None for all)
+
+            record_signal (numpy array): signal of whole record, if it has
+            already been read (optional)
+
+    Returns:
+            (int): number of beats saved
     '''
 
     # get list of locations where annotations are
     ann_locs = ann.sample
 
     # uncomment to extract all heartbeats
-    NUM_HEARTBEATS_TO_EXTRACT = len(ann_locs) - 1
+    beat_numbers = getBeatRange(ann, first_beat, last_beat)
 
     # get path where beats need to be written
-    beat_wr_dir = directory_structure.getWriteDirectory('beat_write_dir', None)
+    with profiling.stage('get_write_directory'):
+        beat_wr_dir = directory_structure.getWriteDirectory('beat_write_dir', None)
+
+    # read record once and slice every beat out of it
+    if record_signal is None:
+        record_signal, fields = getRecordSignal(file_path)
 
     # plot and save the beats in the range selected
-    for beat_number in range(NUM_HEARTBEATS_TO_EXTRACT):
+    for beat_number in beat_numbers:
         beat_start = ann_locs[beat_number] - BEAT_START_OFFSET
         beat_end = ann_locs[beat_number + 1] - BEAT_END_OFFSET
         beat_type = ann.symbol[beat_number]
 
         writeSingleBeat(file_path, beat_start, beat_end,
-                        beat_number, beat_type)
+                        beat_number, beat_type, record_signal)
+
+    return len(beat_numbers)
+
+
+def getBeatWindow(signal):
+    '''
+    resample a beat to a fixed number of samples and scale it to zero mean
+    and unit variance (the same way plotting autoscales the beat)
+
+    Args:
+            signal (list): intensity values of beat
+
+    Returns:
+            window (numpy array): float32 array of WINDOW_LENGTH samples
+    '''
+    signal = np.asarray(signal, dtype=np.float64).reshape(-1)
+    if signal.size == 0:
+        return np.zeros(WINDOW_LENGTH, dtype=np.float32)
+
+    window = np.interp(np.linspace(0, signal.size - 1, WINDOW_LENGTH),
+                       np.arange(signal.size), signal)
+    window -= window.mean()
+    std = window.std()
+    if std > 0:
+        window /= std
+    return window.astype(np.float32)
+
+
+def getRecordBeats(file_path, ann, kind='images', first_beat=0, last_beat=None,
+                   record_signal=None):
+    '''
+    read specified patient file once and cut all of its annotated beats (or
+    a range of them) out of it, either rendered as images or resampled as
+    signal windows
+
+    Args:
+            file_path (str): path of where patient data is present
+
+            ann (annotation): annotation information of file
+
+            kind (str): render images ('images') or resample signal
+            windows ('windows')
+
+            first_beat (int): first beat to cut out
+
+            last_beat (int): beat after last beat to cut out (None for all)
+
+            record_signal (numpy array): signal of whole record, if it has
+            already been read (optional)
+
+    Returns:
+            data (numpy array): beats, first axis is beat
+
+            index (numpy array): index of beats (see beat_shards.createIndex)
+    '''
+    if kind not in beat_shards.SHARD_KINDS:
+        raise Exception("Beat kind must be in list {images, windows}")
+
+    ann_locs = ann.sample
+    beat_numbers = getBeatRange(ann, first_beat, last_beat)
+    num_beats = len(beat_numbers)
+    record_name = getNumbersFromString(os.path.basename(file_path))[0]
+
+    # read record once and slice every beat out of it
+    if record_signal is None:
+        record_signal, fields = getRecordSignal(file_path)
+
+    if kind == 'images':
+        data = np.empty((num_beats, beat_renderer.IMAGE_SIZE,
+                         beat_renderer.IMAGE_SIZE), dtype=np.uint8)
+    else:
+        data = np.empty((num_beats, WINDOW_LENGTH), dtype=np.float32)
+
+    for row, beat_number in enumerate(beat_numbers):
+        beat_start = ann_locs[beat_number] - BEAT_START_OFFSET
+        beat_end = ann_locs[beat_number + 1] - BEAT_END_OFFSET
+        signal = sliceSignal(record_signal, beat_start, beat_end)
+
+        if kind == 'images':
+            with profiling.stage('render_beat'):
+                beat_renderer.renderBeat(signal, data[row])
+        else:
+            with profiling.stage('beat_window'):
+                data[row] = getBeatWindow(signal)
+
+    index = beat_shards.createIndex(int(record_name), np.array(beat_numbers),
+                                    ann_locs[beat_numbers.start:beat_numbers.stop],
+                                    ann.symbol[beat_numbers.start:beat_numbers.stop])
+    return data, index
+
+
+def extractBeatsToShard(file_path, ann, kind='images', first_beat=0,
+                        last_beat=None, record_signal=None):
+    '''
+    extract all beats (or a range of beats) of specified patient file and
+    save them as one packed shard (see beat_shards) instead of one png image
+    per beat
+
+    Args:
+            file_path (str): path of where patient data is present
+
+            ann (annotation): annotation information of file
+
+            kind (str): store rendered images ('images') or resampled
+            signal windows ('windows')
+
+            first_beat (int): first beat to save
+
+            last_beat (int): beat after last beat to save (None for all)
+
+            record_signal (numpy array): signal of whole record, if it has
+            already been read (optional)
+
+    Returns:
+            (int): number of beats saved
+    '''
+    data, index = getRecordBeats(file_path, ann, kind, first_beat, last_beat,
+                                 record_signal)
+    record_name = getNumbersFromString(os.path.basename(file_path))[0]
+    with profiling.stage('write_shard'):
+        beat_shards.writeShard(beat_shards.getShardDirectory(kind),
+                               beat_shards.getShardName(record_name, first_beat),
+                               kind, data, index)
+    profiling.count('beats', len(data))
+    return len(data)
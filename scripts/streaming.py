@@ -0,0 +1,69 @@
+import numpy as np
+from beat_window import BEAT_START_OFFSET, BEAT_END_OFFSET
+from qrs_detector import StreamingQRSDetector
+
+# longest beat (peak to next peak) that is still classified
+MAX_BEAT_SECONDS = 3
+
+
+class BeatStream:
+    """
+    Buffer the samples of one live ECG stream and cut out beats as soon as
+    they are complete.
+
+    A beat starts BEAT_START_OFFSET samples before its QRS peak and ends
+    BEAT_END_OFFSET samples before the next peak, the same window used for
+    extraction, so a beat is complete once the next peak is confirmed by
+    the incremental QRS detector. Only the samples of the open beat are
+    kept, so memory and detection cost do not grow with the length of the
+    stream.
+    """
+
+    def __init__(self, fs=360):
+        self.fs = fs
+        self.detector = StreamingQRSDetector(fs)
+        self.buffer = np.zeros(0, dtype=np.float64)
+        # absolute sample index of buffer[0]
+        self.offset = 0
+        # absolute sample index of last confirmed peak
+        self.last_peak = None
+
+    def push(self, samples):
+        """
+        Add a chunk of samples to the stream.
+
+        Returns:
+            beats (list): (peak sample, beat samples) of every beat
+            completed by this chunk
+        """
+        samples = np.asarray(samples, dtype=np.float64).reshape(-1)
+        self.buffer = np.concatenate([self.buffer, samples])
+
+        beats = []
+        for peak in self.detector.process(samples):
+            if self.last_peak is not None and \
+                    peak - self.last_peak <= MAX_BEAT_SECONDS * self.fs:
+                start = max(self.last_peak - BEAT_START_OFFSET - self.offset, 0)
+                end = peak - BEAT_END_OFFSET - self.offset
+                if end > start:
+                    beats.append((self.last_peak, self.buffer[start:end].copy()))
+            self.last_peak = peak
+
+        self.trim()
+        return beats
+
+    def trim(self):
+        """
+        Drop samples that are not part of the open beat.
+        """
+        # the detector confirms a peak a little after it, keep a margin
+        keep_from = self.offset + len(self.buffer) - self.fs
+        if self.last_peak is not None:
+            keep_from = min(keep_from, self.last_peak - BEAT_START_OFFSET)
+        # an open beat longer than MAX_BEAT_SECONDS is never classified
+        keep_from = max(keep_from, self.offset + len(self.buffer) -
+                        (MAX_BEAT_SECONDS + 1) * self.fs)
+        drop = int(keep_from) - self.offset
+        if drop > 0:
+            self.buffer = self.buffer[drop:]
+            self.offset += drop
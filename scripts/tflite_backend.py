@@ -0,0 +1,102 @@
+import threading
+import numpy as np
+
+# the standalone runtime is much smaller than tensorflow, use it if installed
+try:
+    from tflite_runtime.interpreter import Interpreter
+except ImportError:
+    import tensorflow as tf
+    Interpreter = tf.lite.Interpreter
+
+
+class TFLiteModel:
+    """
+    Run a .tflite model written by export_model.py behind the part of the
+    Keras model interface the service uses: predict() on a batch and
+    input_shape.
+
+    Integer (int8/uint8) inputs and outputs are quantized and dequantized
+    here, so callers pass the same uint8 images they pass to the Keras
+    model and get float probabilities back.
+
+    Resizing the input tensor reallocates the interpreter, far too slow to
+    do whenever the batch size changes. One interpreter is allocated up
+    front for every power of two up to max_batch_size (and max_batch_size
+    itself), a batch is padded to the smallest that fits and larger
+    batches are split. Interpreters are not thread safe, calls to each are
+    serialized with a lock.
+    """
+
+    def __init__(self, model_path, num_threads=None, max_batch_size=32):
+        self.model_path = model_path
+        self.batch_sizes = sorted({min(1 << i, max_batch_size)
+                                   for i in range(max_batch_size.bit_length() + 1)})
+        self.interpreters = {}
+        for batch_size in self.batch_sizes:
+            interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+            input_index = interpreter.get_input_details()[0]["index"]
+            shape = list(interpreter.get_input_details()[0]["shape"])
+            if shape[0] != batch_size:
+                interpreter.resize_tensor_input(input_index, [batch_size] + shape[1:])
+            interpreter.allocate_tensors()
+            self.interpreters[batch_size] = (interpreter, threading.Lock())
+
+        interpreter = self.interpreters[1][0]
+        self.input = interpreter.get_input_details()[0]
+        self.output = interpreter.get_output_details()[0]
+
+    @property
+    def max_batch_size(self):
+        return self.batch_sizes[-1]
+
+    @property
+    def input_shape(self):
+        return (None,) + tuple(int(d) for d in self.input["shape"][1:])
+
+    @property
+    def output_shape(self):
+        return (None,) + tuple(int(d) for d in self.output["shape"][1:])
+
+    def quantize(self, x):
+        dtype = self.input["dtype"]
+        if not np.issubdtype(dtype, np.integer):
+            return x.astype(dtype)
+        scale, zero_point = self.input["quantization"]
+        if scale:
+            x = np.round(x.astype(np.float32) / scale + zero_point)
+        info = np.iinfo(dtype)
+        return np.clip(x, info.min, info.max).astype(dtype)
+
+    def dequantize(self, y):
+        if not np.issubdtype(y.dtype, np.integer):
+            return y
+        scale, zero_point = self.output["quantization"]
+        return (y.astype(np.float32) - zero_point) * scale
+
+    def invoke(self, x):
+        # x holds at most max_batch_size inputs, already quantized
+        batch_size = next(b for b in self.batch_sizes if b >= len(x))
+        if batch_size != len(x):
+            padded = np.zeros((batch_size,) + x.shape[1:], dtype=x.dtype)
+            padded[:len(x)] = x
+        else:
+            padded = x
+        interpreter, lock = self.interpreters[batch_size]
+        with lock:
+            interpreter.set_tensor(self.input["index"], padded)
+            interpreter.invoke()
+            y = interpreter.get_tensor(self.output["index"])
+        return y[:len(x)]
+
+    def predict(self, x):
+        """
+        Args:
+            x (numpy array): batch of inputs, first axis is batch
+
+        Returns:
+            (numpy array): float outputs of the model
+        """
+        x = self.quantize(np.asarray(x))
+        y = np.concatenate([self.invoke(x[start:start + self.max_batch_size])
+                            for start in range(0, len(x), self.max_batch_size)])
+        return self.dequantize(y)
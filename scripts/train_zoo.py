@@ -0,0 +1,352 @@
+# This file trains several models (the names of models.MODEL_TRAINERS and
+# the Alexnet and Novelnet models of cnn_model.createModel) in parallel.
+# The beats are loaded and split once, copied into shared memory and every
+# training runs in its own process that reads them from there without a
+# copy of its own. Each process gets a budget of CPU threads and is pinned
+# to as many cores, so trainings do not fight over the same cores. Weights
+# and metrics are saved by cnn_model.trainAndSaveModel like a single
+# training; the scores, cores and time of all trainings are written to one
+# json file in testing/accuracy_metrics.
+#
+# Nothing heavy is imported at module level: workers are spawned, and
+# tensorflow must only be imported after their thread budget is set.
+
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import directory_structure
+
+# seconds between checks of running trainings
+POLL_SECONDS = 5
+
+
+def parseJobs(specs, default_threads, num_cpus):
+    '''
+    parse model specifications of the form name or name:threads
+
+    Args:
+            specs (list): model specifications
+
+            default_threads (int): threads of models given without a count
+
+            num_cpus (int): cores available, no job gets more
+
+    Returns:
+            (list): (model name, threads) of every job, in the given order
+    '''
+    jobs = []
+    for spec in specs:
+        name, _, threads = spec.partition(':')
+        threads = int(threads) if threads else default_threads
+        if threads < 1:
+            raise Exception("Thread count of {} must be positive".format(name))
+        if any(name == job[0] for job in jobs):
+            raise Exception("Model {} is listed twice".format(name))
+        jobs.append((name, min(threads, num_cpus)))
+    return jobs
+
+
+def shareArray(array):
+    '''
+    copy array into a new shared memory block
+
+    Returns:
+            shm (SharedMemory): block, to be unlinked once all workers are done
+
+            (tuple): name, shape and dtype workers attach with
+    '''
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def attachArray(description):
+    '''
+    read only view of an array shared by shareArray
+
+    Returns:
+            shm (SharedMemory): block, keep it open while the array is used
+
+            array (numpy array): view of the block
+    '''
+    name, shape, dtype = description
+    shm = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype, buffer=shm.buf)
+    array.flags.writeable = False
+    return shm, array
+
+
+def loadData(kind, data_format, size_of_test_data):
+    '''
+    load and split beats the way cnn_model does for a single training
+
+    Args:
+            kind (str): 'images' or 'windows' (signal models)
+
+            data_format (str): read beats from 'png' images or from 'shard's
+
+    Returns:
+            X_train, X_test, y_train, y_test (numpy arrays)
+    '''
+    import cnn_model
+
+    if kind == 'images':
+        if data_format == 'shard':
+            return cnn_model.trainAndTestSplit(
+                cnn_model.getShardDataFrame('images'), size_of_test_data)
+        df, signals = cnn_model.getSignalDataFrame(return_array=True)
+        return cnn_model.trainAndTestSplit(df, size_of_test_data, signals=signals)
+
+    if data_format == 'shard':
+        df = cnn_model.getShardDataFrame('windows')
+    else:
+        df = cnn_model.getBeatWindowDataFrame()
+    return cnn_model.trainAndTestSplit(df, size_of_test_data, images=False)
+
+
+def limitThreads(cpus, threads):
+    '''
+    pin this process to cpus and size tensorflow's thread pools, must run
+    before tensorflow is imported
+    '''
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    for variable in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                     'TF_NUM_INTRAOP_THREADS']:
+        os.environ[variable] = str(threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = str(min(2, threads))
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(min(2, threads))
+
+
+def trainWorker(model_name, cpus, threads, data, cache_features, log_path, results):
+    '''
+    train one model in a spawned process on the shared data and put its
+    score (or the error it failed with) on the results queue
+    '''
+    # output of keras and tensorflow goes to the log of this model
+    log = open(log_path, 'w')
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+
+    result = {'model': model_name, 'cpus': sorted(cpus), 'threads': threads,
+              'log': log_path}
+    start = time.perf_counter()
+    blocks = []
+    try:
+        limitThreads(cpus, threads)
+        import cnn_model
+
+        arrays = []
+        for description in data:
+            shm, array = attachArray(description)
+            blocks.append(shm)
+            arrays.append(array)
+        X_train, X_test, y_train, y_test = arrays
+
+        score = cnn_model.trainAndSaveModel(
+            model_name, X_train, X_test, y_train, y_test, cache_features)
+        result['loss'] = float(score[0])
+        result['accuracy'] = float(score[1])
+    except Exception:
+        result['error'] = traceback.format_exc()
+        traceback.print_exc()
+    finally:
+        result['seconds'] = time.perf_counter() - start
+        results.put(result)
+        sys.stdout.flush()
+        for shm in blocks:
+            shm.close()
+
+
+def runJobs(jobs, kinds, data, cpus, cache_features, log_dir, time_limit=None,
+            backfill_limit=1800):
+    '''
+    run jobs in parallel, starting every job (in the given order) as soon
+    as enough cores are free for its thread budget. While the first waiting
+    job lacks cores, later jobs that fit are started on the idle cores, but
+    only until it has waited backfill_limit seconds; then no other job is
+    started before it, so a large job can not be starved by small ones
+
+    Args:
+            jobs (list): (model name, threads) of every job
+
+            kinds (dict): 'images' or 'windows' by model name
+
+            data (dict): shared array descriptions by kind
+
+            cpus (list): cores jobs are pinned to
+
+            time_limit (float): seconds after which no new job is started
+
+            backfill_limit (float): seconds the first waiting job lets later
+            jobs go ahead of it
+
+    Returns:
+            (list): result of every job, skipped jobs have an error
+    '''
+    context = multiprocessing.get_context('spawn')
+    results_queue = context.Queue()
+    pending = list(jobs)
+    free = sorted(cpus)
+    running = {}
+    results = []
+    # time each job was first kept waiting for cores while first in line
+    waiting = {}
+    start = time.perf_counter()
+
+    def finish(name, result):
+        process, assigned, started = running.pop(name)
+        process.join()
+        free.extend(assigned)
+        free.sort()
+        results.append(result)
+        status = result.get('error', '').strip().splitlines()
+        print("{} {} after {:.0f}s".format(
+            name, 'failed: ' + status[-1] if status else 'finished',
+            result['seconds']), flush=True)
+
+    while pending or running:
+        if time_limit is not None and time.perf_counter() - start > time_limit:
+            for name, threads in pending:
+                results.append({'model': name, 'threads': threads, 'seconds': 0,
+                                'error': 'not started within time limit'})
+            pending = []
+
+        for job in list(pending):
+            name, threads = job
+            if threads > len(free):
+                if job == pending[0]:
+                    blocked = waiting.setdefault(name, time.perf_counter())
+                    if time.perf_counter() - blocked > backfill_limit:
+                        break
+                continue
+            assigned = free[:threads]
+            del free[:threads]
+            log_path = os.path.join(log_dir, name + '.log')
+            process = context.Process(
+                target=trainWorker, name=name,
+                args=(name, assigned, threads, data[kinds[name]], cache_features,
+                      log_path, results_queue))
+            process.start()
+            running[name] = (process, assigned, time.perf_counter())
+            pending.remove(job)
+            print("Started {} on cores {} (log {})".format(name, assigned, log_path),
+                  flush=True)
+
+        if not running:
+            break
+
+        try:
+            result = results_queue.get(timeout=POLL_SECONDS)
+            if result['model'] in running:
+                finish(result['model'], result)
+        except queue.Empty:
+            # workers put their result before exiting, a worker gone without
+            # one was killed (e.g. out of memory)
+            for name, (process, assigned, started) in list(running.items()):
+                if process.exitcode is not None and process.exitcode != 0:
+                    finish(name, {'model': name, 'cpus': assigned,
+                                  'threads': len(assigned),
+                                  'seconds': time.perf_counter() - started,
+                                  'error': 'worker exited with code {}'.format(
+                                      process.exitcode)})
+
+    return results
+
+
+if __name__ == '__main__':
+    import cnn_model
+    import models
+
+    available_cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') \
+        else list(range(os.cpu_count()))
+
+    args = argparse.ArgumentParser()
+    args.add_argument('--models', type=str, nargs='+', default=['vgg16', 'vgg19'],
+                      help='models to train, as name or name:threads '
+                      '(choose from {}), slowest first'.format(
+                          ', '.join(sorted(models.MODEL_TRAINERS) + cnn_model.CREATED_MODELS)))
+    args.add_argument('--cpus', type=int, nargs='*', default=available_cpus,
+                      help='cores trainings are pinned to (default all)')
+    args.add_argument('--threads', type=int, default=None,
+                      help='threads of each training (default cores / models)')
+    args.add_argument('--data-format', type=str, default='png', choices=['png', 'shard'],
+                      help='read beats from png images or from packed shards')
+    args.add_argument('--test-size', type=float, default=0.2,
+                      help='size of test data')
+    args.add_argument('--cache-features', action='store_true',
+                      help='run frozen backbones once and train their heads on cached features')
+    args.add_argument('--time-limit', type=float, default=None,
+                      help='hours after which no new training is started')
+    args.add_argument('--backfill-minutes', type=float, default=30,
+                      help='minutes later trainings may use idle cores ahead of the '
+                      'first waiting one')
+    args = args.parse_args()
+
+    if not args.cpus or not set(args.cpus) <= set(available_cpus):
+        raise Exception("Cores must be in list {}".format(available_cpus))
+    default_threads = args.threads or max(1, len(args.cpus) // len(args.models))
+    jobs = parseJobs(args.models, default_threads, len(args.cpus))
+    known = set(models.MODEL_TRAINERS) | set(cnn_model.CREATED_MODELS)
+    for name, threads in jobs:
+        if name not in known:
+            raise Exception("Model must be in list {}".format(sorted(known)))
+    kinds = {name: 'windows' if name in models.SIGNAL_MODELS else 'images'
+             for name, threads in jobs}
+
+    # every kind of data is loaded once and shared by all its trainings
+    blocks = []
+    data = {}
+    try:
+        for kind in sorted(set(kinds.values())):
+            print("Loading", kind, flush=True)
+            data[kind] = []
+            for array in loadData(kind, args.data_format, args.test_size):
+                shm, description = shareArray(np.ascontiguousarray(array))
+                blocks.append(shm)
+                data[kind].append(description)
+            print("Shared {} ({:.1f} MB)".format(kind, sum(
+                np.prod(shape) * np.dtype(dtype).itemsize
+                for name, shape, dtype in data[kind]) / 1e6), flush=True)
+
+        log_dir = directory_structure.getWriteDirectory('testing', 'zoo_logs')
+        start_time = time.strftime('%Y%m%d-%H%M%S')
+        start = time.perf_counter()
+        results = runJobs(jobs, kinds, data, args.cpus, args.cache_features, log_dir,
+                          None if args.time_limit is None else args.time_limit * 3600,
+                          args.backfill_minutes * 60)
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    report = {
+        'start': start_time,
+        'seconds': time.perf_counter() - start,
+        'cpus': args.cpus,
+        'data_format': args.data_format,
+        'results': sorted(results, key=lambda r: r.get('accuracy', -1), reverse=True),
+    }
+    metrics_path = directory_structure.getWriteDirectory('testing', 'accuracy_metrics')
+    with open(os.path.join(metrics_path, 'zoo_' + start_time + '.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print("{:<12}{:>10}{:>10}{:>10}".format("model", "accuracy", "threads", "minutes"))
+    for result in report['results']:
+        accuracy = result.get('accuracy')
+        print("{:<12}{:>10}{:>10}{:>10.1f}".format(
+            result['model'], 'failed' if accuracy is None else '{:.4f}'.format(accuracy),
+            result['threads'], result['seconds'] / 60))
+
+    if any('error' in result for result in results):
+        sys.exit(1)